@@ -12,9 +12,9 @@ def run_dev():
     env["PYTHONPATH"] = os.getcwd()
 
     print("🛰️  Starting Backend...")
-    # Using 'python -m uvicorn' ensures we use the installed package in the current venv
+    # Runs WEB_WORKERS uvicorn processes (default 1) with the installed packages of the current venv
     backend_proc = subprocess.Popen([
-        python_exe, "-m", "uvicorn", "backend.main:app", 
+        python_exe, "-m", "backend.serve", 
         "--host", "0.0.0.0", 
         "--port", "8000"
     ], env=env)
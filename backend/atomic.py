@@ -0,0 +1,120 @@
+"""Atomic file writes and locks shared by every server process.
+
+With several server processes on one storage volume, no reader may ever
+see a half-written file, and work on one key (a rendition, an upscale, the
+index rebuild) should run in one process while the others wait for its
+result. Writes therefore go to a hidden temporary file in the target's
+folder that is then renamed over it, and locks are flock()s on small files
+that every process opens by the same name.
+"""
+import asyncio
+import hashlib
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # No flock() on Windows, where the backend only runs as one process.
+    fcntl = None
+
+# Keys are hashed onto this many lock files so the folder never grows.
+LOCK_STRIPES = 4096
+
+
+def temp_path(path) -> Path:
+    """A hidden sibling of path with the same extension, so encoders pick the same format."""
+    path = Path(path)
+    return path.with_name(f".{path.stem}.{uuid.uuid4().hex[:12]}.tmp{path.suffix}")
+
+
+@contextmanager
+def replacing(path):
+    """Yields a temporary path to write; it replaces path only if the block succeeds."""
+    tmp = temp_path(path)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def write_atomic(path, data):
+    """Writes data to path so that readers see either the old file or the whole new one."""
+    with replacing(path) as tmp:
+        with open(tmp, "wb") as f:
+            f.write(data)
+
+
+class FileLock:
+    """An exclusive lock held by at most one thread in one process at a time.
+
+    Every acquire opens the lock file afresh, so threads of the same process
+    exclude each other just like separate processes do.
+    """
+
+    # Seconds between attempts while waiting asynchronously, growing to the maximum.
+    poll_interval = 0.02
+    max_poll_interval = 0.5
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: int | None = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    async def acquire_async(self):
+        """Waits for the lock without tying up a thread, and is safe to cancel."""
+        delay = self.poll_interval
+        while not self.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class LockFolder:
+    """Hands out FileLocks kept in one folder of the shared volume."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def named(self, name: str) -> FileLock:
+        """A lock of its own, for long-held singletons such as maintenance."""
+        return FileLock(self.root / f"{name}.lock")
+
+    def for_key(self, key: str) -> FileLock:
+        """The lock for an arbitrary key; unrelated keys rarely share one."""
+        stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+        return FileLock(self.root / f"key-{stripe:03x}.lock")
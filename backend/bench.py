@@ -0,0 +1,412 @@
+"""Reproducible benchmarks for the shrink and upscale paths.
+
+    python -m backend.bench --sizes 1,12,50 --output bench.json
+    python -m backend.bench --compare before.json after.json
+
+Synthetic images are generated from a fixed seed, so runs on one machine are
+comparable. "function" cases time single pipeline steps in this process;
+"http" cases start backend.main:app under uvicorn with a scratch storage
+root (or target --url) and send requests at each concurrency level. Every
+case reports throughput, latency percentiles and the peak RSS of the process
+doing the work.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cv2
+import numpy as np
+import requests
+
+from . import codecs
+from .codecs import QualityTarget
+from .pipeline import apply_rotation, decode_image, shrink_upload, upscale_stored
+from .upscaler import load_engine
+
+FUNCTION_OPS = ("decode", "rotate", "resize", "encode", "shrink", "upscale")
+HTTP_OPS = ("shrink", "upscale")
+ENCODE_PARAMS = {
+    "jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90]),
+    "png": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 3]),
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 90]),
+}
+SEED = 1234
+# Numbers the upload variants so no two requests in a run share content.
+_variants = itertools.count()
+
+
+# --- Inputs ---
+
+def synthetic_image(megapixels: float, seed: int = SEED):
+    """A 4:3 BGR image with smooth structure plus sensor-like noise.
+
+    Pure noise would make every codec look terrible and flat colour would
+    make them look great; this sits in between, like a photo.
+    """
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, size=(max(2, height // 64), max(2, width // 64), 3), dtype=np.uint8)
+    img = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0, 6, size=(height, width, 1)).astype(np.int16)
+    return np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def encode_input(img, fmt: str) -> bytes:
+    extension, params = ENCODE_PARAMS[fmt]
+    success, encoded = cv2.imencode(extension, img, params)
+    if not success:
+        raise RuntimeError(f"Could not encode a {fmt} input")
+    return encoded.tobytes()
+
+
+def unique_variant(content: bytes, n: int) -> bytes:
+    """Same pixels, different bytes, so the content-addressed cache never hits.
+
+    Decoders ignore data after the end of the image.
+    """
+    return content + b"bench" + n.to_bytes(8, "big")
+
+
+# --- Measurement ---
+
+def _rss_bytes(pid: int | str = "self") -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler:
+    """Samples a process's resident set size in the background; keeps the peak."""
+
+    def __init__(self, pid: int | str = "self", interval: float = 0.005):
+        self.pid = pid
+        self.interval = interval
+        self.start_rss = _rss_bytes(pid)
+        self.peak = self.start_rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = _rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(values, p: float) -> float:
+    """Linear-interpolated percentile of values (0 <= p <= 100)."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(latencies, wall: float, sampler: RssSampler, megapixels: float, errors: int = 0) -> dict:
+    mb = 1024**2
+    ok = len(latencies) - errors
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "wall_s": round(wall, 4),
+        "throughput_per_s": round(ok / wall, 3) if wall else None,
+        "megapixels_per_s": round(ok * megapixels / wall, 3) if wall else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3),
+        },
+        "rss_before_mb": round(sampler.start_rss / mb, 1) if sampler.start_rss else None,
+        "peak_rss_mb": round(sampler.peak / mb, 1) if sampler.peak else None,
+    }
+
+
+# --- Function-level cases ---
+
+def _function_case(op: str, img, content: bytes, fmt: str, width: int, scratch: Path):
+    """Returns (prepare, call) for one op; prepare's result is passed to call and not timed."""
+    height = int(width * img.shape[0] / img.shape[1])
+    target = QualityTarget()
+    if op == "decode":
+        return lambda i: content, decode_image
+    if op == "rotate":
+        return lambda i: img, lambda x: apply_rotation(x, 90)
+    if op == "resize":
+        return lambda i: img, lambda x: cv2.resize(x, (width, height), interpolation=cv2.INTER_AREA)
+    if op == "encode":
+        shrunk = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        return lambda i: shrunk, lambda x: codecs.encode(x, "webp", target)
+    if op == "shrink":
+        def call(i):
+            return shrink_upload(content, str(scratch / f"o{i}.{fmt}"),
+                                 [(width, "webp", str(scratch / f"s{i}.webp"))], 0, target)
+        return lambda i: i, call
+    if op == "upscale":
+        # Back from a shrunk rendition to full size, as /upscale does.
+        shrunk = scratch / "shrunk.webp"
+        encoded, _ = codecs.encode(cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA),
+                                   "webp", target)
+        shrunk.write_bytes(encoded)
+        full_w, full_h = img.shape[1], img.shape[0]
+        return lambda i: i, lambda i: upscale_stored(str(shrunk), str(scratch / f"u{i}.{fmt}"), full_w, full_h)
+    raise ValueError(f"Unknown op {op!r}")
+
+
+def run_function_cases(args, images) -> list:
+    results = []
+    load_engine()
+    for megapixels, fmt, img, content in images:
+        for op in args.ops:
+            if op not in FUNCTION_OPS:
+                continue
+            with tempfile.TemporaryDirectory(prefix="bench-") as scratch:
+                prepare, call = _function_case(op, img, content, fmt, args.width, Path(scratch))
+                call(prepare(-1))  # warm-up: first-call allocations and lazy imports
+                latencies = []
+                with RssSampler() as sampler:
+                    for i in range(args.iterations):
+                        value = prepare(i)
+                        t0 = time.perf_counter()
+                        call(value)
+                        latencies.append(time.perf_counter() - t0)
+                    wall = sum(latencies)
+                results.append({
+                    "mode": "function", "op": op, "megapixels": megapixels, "format": fmt,
+                    "concurrency": 1, **summarize(latencies, wall, sampler, megapixels),
+                })
+                _report(results[-1])
+    return results
+
+
+# --- HTTP cases ---
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(storage_root: str):
+    """Runs backend.main:app under uvicorn on a free port; returns (process, base_url)."""
+    port = _free_port()
+    env = os.environ.copy()
+    env["STORAGE_ROOT"] = storage_root
+    # Large synthetic PNGs exceed the default upload cap.
+    env.setdefault("MAX_UPLOAD_BYTES", str(1024**3))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app",
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=Path(__file__).resolve().parent.parent, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The benchmark server exited during startup")
+        try:
+            if requests.get(f"{base_url}/metrics", timeout=1).ok:
+                return process, base_url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("The benchmark server did not start within 120s")
+
+
+def _drive(n: int, concurrency: int, send):
+    """Calls send(i) for i in range(n) from `concurrency` threads; returns (latencies, errors, wall)."""
+    local = threading.local()
+
+    def timed(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        t0 = time.perf_counter()
+        response = send(local.session, i)
+        return time.perf_counter() - t0, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(timed, range(n)))
+    wall = time.perf_counter() - started
+    return [o[0] for o in outcomes], sum(o[1] >= 400 for o in outcomes), wall
+
+
+def run_http_cases(args, images, base_url: str, server_pid: int | None) -> list:
+    results = []
+    run_id = int(time.time())
+    for megapixels, fmt, _, content in images:
+        mime = "image/png" if fmt == "png" else f"image/{fmt}"
+        for concurrency in args.concurrency:
+            prefix = f"bench-{run_id}-{megapixels:g}mp-{fmt}-c{concurrency}"
+
+            def shrink(session, i, tag="s"):
+                files = {"file": (f"{prefix}-{tag}{i}.{fmt}", unique_variant(content, next(_variants)), mime)}
+                return session.post(f"{base_url}/shrink", params={"width": args.width},
+                                    files=files, timeout=args.timeout)
+
+            def upscale(session, i):
+                return session.post(f"{base_url}/upscale", timeout=args.timeout,
+                                    params={"file_key": f"{prefix}-u{i}.{fmt}", "wait": "true"})
+
+            for op in args.ops:
+                if op not in HTTP_OPS:
+                    continue
+                if op == "upscale":
+                    # Every job needs its own stored original, or the queue would merge them.
+                    _drive(args.requests, concurrency, lambda s, i: shrink(s, i, tag="u"))
+                send = shrink if op == "shrink" else upscale
+                with RssSampler(server_pid or "self") as sampler:
+                    latencies, errors, wall = _drive(args.requests, concurrency, send)
+                summary = summarize(latencies, wall, sampler, megapixels, errors)
+                if server_pid is None:
+                    # An external server's memory is not visible from here.
+                    summary["rss_before_mb"] = summary["peak_rss_mb"] = None
+                results.append({
+                    "mode": "http", "op": op, "megapixels": megapixels, "format": fmt,
+                    "concurrency": concurrency, **summary,
+                })
+                _report(results[-1])
+    return results
+
+
+# --- Reporting ---
+
+def _case_key(result: dict):
+    return result["mode"], result["op"], result["megapixels"], result["format"], result["concurrency"]
+
+
+def _report(result: dict):
+    latency = result["latency_ms"]
+    print(
+        f"{result['mode']:8} {result['op']:7} {result['megapixels']:>5g}MP {result['format']:4} "
+        f"c={result['concurrency']:<3} {result['throughput_per_s']:>8}/s "
+        f"p50={latency['p50']:.1f}ms p95={latency['p95']:.1f}ms p99={latency['p99']:.1f}ms "
+        f"peak_rss={result['peak_rss_mb']}MB errors={result['errors']}",
+        flush=True,
+    )
+
+
+def compare(before_path: str, after_path: str):
+    """Prints the p50 and throughput change of every case present in both files."""
+    before = {_case_key(r): r for r in json.loads(Path(before_path).read_text())["results"]}
+    after = {_case_key(r): r for r in json.loads(Path(after_path).read_text())["results"]}
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        mode, op, megapixels, fmt, concurrency = key
+        print(
+            f"{mode:8} {op:7} {megapixels:>5g}MP {fmt:4} c={concurrency:<3} "
+            f"p50 {old['latency_ms']['p50']:.1f} -> {new['latency_ms']['p50']:.1f}ms "
+            f"({change(old['latency_ms']['p50'], new['latency_ms']['p50'])})  "
+            f"throughput {change(old['throughput_per_s'], new['throughput_per_s'])}  "
+            f"peak_rss {old['peak_rss_mb']} -> {new['peak_rss_mb']}MB"
+        )
+    only_before, only_after = len(before.keys() - after.keys()), len(after.keys() - before.keys())
+    if only_before or only_after:
+        print(f"{only_before} cases only in {before_path}, {only_after} only in {after_path}")
+
+
+def _csv(cast):
+    return lambda value: [cast(v) for v in value.split(",") if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.bench", description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=_csv(float), default=[1, 4, 12, 24, 50],
+                        help="image sizes in megapixels (default: 1,4,12,24,50)")
+    parser.add_argument("--formats", type=_csv(str), default=["jpeg", "png", "webp"],
+                        help=f"input formats, any of {','.join(ENCODE_PARAMS)}")
+    parser.add_argument("--modes", type=_csv(str), default=["function", "http"])
+    parser.add_argument("--ops", type=_csv(str), default=list(FUNCTION_OPS),
+                        help=f"function ops {','.join(FUNCTION_OPS)}; http ops {','.join(HTTP_OPS)}")
+    parser.add_argument("--width", type=int, default=1280, help="shrink target width")
+    parser.add_argument("--iterations", type=int, default=5, help="calls per function case")
+    parser.add_argument("--requests", type=int, default=8, help="requests per HTTP case")
+    parser.add_argument("--concurrency", type=_csv(int), default=[1, 4])
+    parser.add_argument("--timeout", type=float, default=600, help="seconds per HTTP request")
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two result files instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    unknown = set(args.formats) - set(ENCODE_PARAMS)
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(sorted(unknown))}")
+
+    images = []
+    for megapixels in args.sizes:
+        img = synthetic_image(megapixels)
+        for fmt in args.formats:
+            images.append((megapixels, fmt, img, encode_input(img, fmt)))
+
+    results = []
+    if "function" in args.modes:
+        results += run_function_cases(args, images)
+    if "http" in args.modes:
+        if args.url:
+            results += run_http_cases(args, images, args.url.rstrip("/"), None)
+        else:
+            with tempfile.TemporaryDirectory(prefix="bench-storage-") as storage_root:
+                process, base_url = start_server(storage_root)
+                try:
+                    results += run_http_cases(args, images, base_url, process.pid)
+                finally:
+                    process.terminate()
+                    process.wait()
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": SEED,
+            "args": {k: v for k, v in vars(args).items() if k != "compare"},
+        },
+        "results": sorted(results, key=_case_key),
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""In-memory caching for hot derived images.
+
+LRUBytesCache keeps recently served encoded images in memory in front of
+the on-disk derived cache, and SingleFlight makes concurrent requests for
+the same image share one render instead of each starting their own. Both
+are only used from the event loop, so neither needs a lock.
+"""
+import asyncio
+from collections import OrderedDict
+
+from . import config
+
+
+class LRUBytesCache:
+    """Byte strings by key, evicting least recently used entries beyond max_bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> bytes | None:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            # Would evict everything else and still not fit.
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers share its result."""
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def run(self, key: str, fn):
+        """Returns `await fn()`, or the result of the identical call already running.
+
+        Returns (result, shared), where shared says whether another caller
+        started the work.
+        """
+        future = self._calls.get(key)
+        shared = future is not None
+        if not shared:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        # A caller that disconnects must not cancel the work the others wait for.
+        return await asyncio.shield(future), shared
+
+    def _finish(self, key: str, future: asyncio.Future):
+        self._calls.pop(key, None)
+        if not future.cancelled():
+            # Mark the exception retrieved even if every waiter went away.
+            future.exception()
+
+
+rendition_cache = LRUBytesCache(config.IMG_MEMORY_CACHE_BYTES)
+rendition_flights = SingleFlight()
@@ -0,0 +1,211 @@
+"""Output codecs and adaptive quality selection for shrunk renditions.
+
+Each codec encodes a BGR array in memory at a given quality. A
+QualityTarget either fixes that quality or states a goal (maximum bytes,
+minimum SSIM or minimum PSNR) that is met by binary-searching the quality
+on the already resized image, so no extra decodes of the original happen.
+"""
+import io
+import math
+
+import cv2
+import numpy as np
+from PIL import Image, features
+
+
+class CodecError(Exception):
+    """An image could not be encoded with the requested codec."""
+
+
+class Codec:
+    name = "base"
+    extension = ""
+    # Quality range searched in target mode; None means quality has no effect.
+    quality_range: tuple[int, int] | None = (1, 100)
+
+    def available(self) -> bool:
+        return True
+
+    def encode(self, img, quality: int):
+        raise NotImplementedError
+
+
+class OpenCVCodec(Codec):
+    def __init__(self, name: str, extension: str, quality_flag=None, extra_params=(),
+                 quality_range=(1, 100)):
+        self.name = name
+        self.extension = extension
+        self.quality_flag = quality_flag
+        self.extra_params = list(extra_params)
+        self.quality_range = quality_range if quality_flag is not None else None
+
+    def available(self) -> bool:
+        return cv2.haveImageWriter(self.extension)
+
+    def encode(self, img, quality: int):
+        params = list(self.extra_params)
+        if self.quality_flag is not None:
+            params += [self.quality_flag, quality]
+        success, encoded = cv2.imencode(self.extension, img, params)
+        if not success:
+            raise CodecError(f"OpenCV failed to write {self.name.upper()}.")
+        return encoded
+
+
+class PillowAVIFCodec(Codec):
+    """AVIF through Pillow, for OpenCV builds compiled without an AVIF writer."""
+
+    name = "avif"
+    extension = ".avif"
+
+    def available(self) -> bool:
+        return features.check("avif")
+
+    def encode(self, img, quality: int):
+        buf = io.BytesIO()
+        Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).save(buf, format="AVIF", quality=quality)
+        return np.frombuffer(buf.getbuffer(), dtype=np.uint8)
+
+
+def _avif_codec() -> Codec:
+    if hasattr(cv2, "IMWRITE_AVIF_QUALITY") and cv2.haveImageWriter(".avif"):
+        return OpenCVCodec("avif", ".avif", cv2.IMWRITE_AVIF_QUALITY)
+    return PillowAVIFCodec()
+
+
+CODECS: dict[str, Codec] = {
+    "webp": OpenCVCodec("webp", ".webp", cv2.IMWRITE_WEBP_QUALITY),
+    # Progressive with optimised Huffman tables: the libjpeg options closest
+    # to what mozjpeg does by default.
+    "jpeg": OpenCVCodec(
+        "jpeg", ".jpg", cv2.IMWRITE_JPEG_QUALITY,
+        extra_params=(cv2.IMWRITE_JPEG_PROGRESSIVE, 1, cv2.IMWRITE_JPEG_OPTIMIZE, 1),
+    ),
+    "png": OpenCVCodec("png", ".png"),
+    "avif": _avif_codec(),
+}
+
+
+def get_codec(name: str) -> Codec:
+    codec = CODECS.get(name)
+    if codec is None or not codec.available():
+        raise CodecError(f"Unsupported format: {name}")
+    return codec
+
+
+class QualityTarget:
+    """A fixed quality, or one goal the encoder searches quality for.
+
+    At most one of max_bytes, min_ssim and min_psnr may be set.
+    """
+
+    def __init__(self, quality: int = 80, max_bytes: int | None = None,
+                 min_ssim: float | None = None, min_psnr: float | None = None):
+        goals = [goal for goal in (max_bytes, min_ssim, min_psnr) if goal is not None]
+        if len(goals) > 1:
+            raise ValueError("Only one of max_bytes, min_ssim and min_psnr can be set")
+        # Quality 101 and up switches WebP to lossless, and every value must
+        # give a spec that index.SHRUNK_NAME_RE recognises.
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        if min_ssim is not None and not 0 < min_ssim <= 1:
+            raise ValueError("min_ssim must be above 0 and at most 1")
+        if min_psnr is not None and not (0 < min_psnr and math.isfinite(min_psnr)):
+            raise ValueError("min_psnr must be a positive number")
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.min_ssim = min_ssim
+        self.min_psnr = min_psnr
+
+    @property
+    def spec(self) -> str:
+        """A short token identifying this target in cache keys and file names."""
+        if self.max_bytes is not None:
+            return f"b{self.max_bytes}"
+        if self.min_ssim is not None:
+            return f"s{_number_token(self.min_ssim)}"
+        if self.min_psnr is not None:
+            return f"p{_number_token(self.min_psnr)}"
+        return f"q{self.quality}"
+
+    @property
+    def has_goal(self) -> bool:
+        return self.max_bytes is not None or self.min_ssim is not None or self.min_psnr is not None
+
+    def spec_for(self, fmt: str) -> str:
+        """spec for renditions in fmt; formats without a quality setting encode every target alike."""
+        codec = CODECS.get(fmt)
+        return "lossless" if codec is not None and codec.quality_range is None else self.spec
+
+
+def _number_token(value: float) -> str:
+    # Fixed-point, never exponent notation: 0.95 -> "0.95", 40.0 -> "40".
+    return f"{value:.6f}".rstrip("0").rstrip(".")
+
+
+def ssim(a, b) -> float:
+    """Mean structural similarity of two same-sized BGR images, on luma."""
+    x = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    y = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    def blur(z):
+        return cv2.GaussianBlur(z, (11, 11), 1.5)
+
+    mu_x, mu_y = blur(x), blur(y)
+    var_x = blur(x * x) - mu_x * mu_x
+    var_y = blur(y * y) - mu_y * mu_y
+    cov = blur(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / (
+        (mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)
+    )
+    return float(ssim_map.mean())
+
+
+def _meets(img, encoded, target: QualityTarget) -> bool:
+    decoded = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    if decoded is None:
+        # Decoder support can lag encoder support (e.g. AVIF); treat as unmet.
+        return False
+    if target.min_ssim is not None:
+        return ssim(img, decoded) >= target.min_ssim
+    return cv2.PSNR(img, decoded) >= target.min_psnr
+
+
+def encode(img, fmt: str, target: QualityTarget):
+    """Encodes img for target; returns (encoded, quality used).
+
+    For max_bytes this is the highest quality that fits (or the lowest
+    quality if nothing does); for min_ssim/min_psnr it is the lowest quality
+    that reaches the threshold (or the highest if nothing does).
+    """
+    codec = get_codec(fmt)
+    if codec.quality_range is None:
+        return codec.encode(img, target.quality), None
+    if not target.has_goal:
+        return codec.encode(img, target.quality), target.quality
+
+    lo, hi = codec.quality_range
+    best = None
+    if target.max_bytes is not None:
+        # Size grows with quality: find the highest quality within budget.
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            encoded = codec.encode(img, mid)
+            if len(encoded) <= target.max_bytes:
+                best, lo = (encoded, mid), mid + 1
+            else:
+                hi = mid - 1
+        return best or (codec.encode(img, codec.quality_range[0]), codec.quality_range[0])
+
+    # Fidelity grows with quality: find the lowest quality that is good enough.
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        encoded = codec.encode(img, mid)
+        if _meets(img, encoded, target):
+            best, hi = (encoded, mid), mid - 1
+        else:
+            lo = mid + 1
+    return best or (codec.encode(img, codec.quality_range[1]), codec.quality_range[1])
@@ -0,0 +1,173 @@
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    """Reads an integer setting from the environment, falling back to default."""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise RuntimeError(f"{name} must be an integer, got {value!r}")
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise RuntimeError(f"{name} must be a number, got {value!r}")
+
+
+def _env_str(name: str, default: str) -> str:
+    value = os.environ.get(name)
+    return value.strip() if value and value.strip() else default
+
+
+CPU_COUNT = os.cpu_count() or 1
+
+# --- Server Processes ---
+# Server processes started by `python -m backend.serve`; 0 starts one per
+# core. All of them share the port, the storage volume and its index.
+WEB_WORKERS = _env_int("WEB_WORKERS", 1)
+SERVER_PROCESSES = WEB_WORKERS if WEB_WORKERS > 0 else CPU_COUNT
+# Cores per server process; the pool and thread defaults below use this so
+# N processes together never start more threads than there are cores.
+CPU_SHARE = max(1, CPU_COUNT // SERVER_PROCESSES)
+# Threads OpenCV may use inside one process (cv2.setNumThreads).
+OPENCV_THREADS = _env_int("OPENCV_THREADS", CPU_SHARE)
+
+# --- Worker Pools ---
+# "thread" is the default because OpenCV releases the GIL inside its heavy
+# calls; "process" isolates each job completely at the cost of pickling
+# arguments and results across the process boundary.
+POOL_KIND = _env_str("POOL_KIND", "thread")
+
+# Shrinks are short and numerous, so they get most of the cores.
+SHRINK_WORKERS = _env_int("SHRINK_WORKERS", CPU_SHARE)
+SHRINK_QUEUE = _env_int("SHRINK_QUEUE", CPU_SHARE * 4)
+
+# Upscales are long-running; keep them on a separate, smaller pool so they
+# can never starve the shrink path.
+UPSCALE_WORKERS = _env_int("UPSCALE_WORKERS", max(1, CPU_SHARE // 4))
+UPSCALE_QUEUE = _env_int("UPSCALE_QUEUE", 8)
+
+# Seconds a client should wait before retrying after a 503.
+RETRY_AFTER = _env_int("RETRY_AFTER", 2)
+
+# --- Upscaler Engine ---
+# The default engine for requests that do not pick one. "auto" uses the
+# first of Real-ESRGAN, FSRCNN, ESPCN and Lanczos whose packages and weights
+# are present.
+UPSCALER_BACKEND = _env_str("UPSCALER_BACKEND", "auto")
+REALESRGAN_MODEL_PATH = _env_str("REALESRGAN_MODEL_PATH", "RealESRGAN_x4plus.pth")
+UPSCALER_DEVICE = _env_str("UPSCALER_DEVICE", "auto")
+# Folder with the OpenCV dnn_superres models, e.g. FSRCNN_x4.pb and ESPCN_x2.pb.
+SR_MODEL_DIR = _env_str("SR_MODEL_DIR", "models")
+# Unsharp mask strength applied after Lanczos upscaling; 0 disables it.
+UPSCALE_SHARPEN = _env_float("UPSCALE_SHARPEN", 0.6)
+
+# --- Tiled Upscaling ---
+# Originals with at least UPSCALE_TILE_MIN_PIXELS pixels are upscaled in
+# tiles of UPSCALE_TILE_SIZE source pixels (0 disables tiling), each with
+# UPSCALE_TILE_OVERLAP pixels of blended context on every side.
+UPSCALE_TILE_SIZE = _env_int("UPSCALE_TILE_SIZE", 512)
+UPSCALE_TILE_OVERLAP = _env_int("UPSCALE_TILE_OVERLAP", 16)
+UPSCALE_TILE_MIN_PIXELS = _env_int("UPSCALE_TILE_MIN_PIXELS", 4_000_000)
+UPSCALE_TILE_WORKERS = _env_int("UPSCALE_TILE_WORKERS", CPU_SHARE)
+
+# --- Derived Artifact Cache ---
+# Total bytes of shrunk renditions kept on disk before the least recently
+# used ones are deleted. Originals never count against this budget.
+DERIVED_CACHE_BYTES = _env_int("DERIVED_CACHE_BYTES", 5 * 1024**3)
+# The same for upscaled images, which are far larger and rarely reused.
+UPSCALED_CACHE_BYTES = _env_int("UPSCALED_CACHE_BYTES", 20 * 1024**3)
+
+# --- Object Storage ---
+# "local" keeps everything under STORAGE_ROOT. "s3" also stores every file in
+# an S3-compatible bucket (needs boto3), with STORAGE_ROOT as a local cache,
+# so several nodes can share storage; credentials come from the usual AWS
+# environment variables or config files.
+STORAGE_BACKEND = _env_str("STORAGE_BACKEND", "local")
+S3_BUCKET = _env_str("S3_BUCKET", "")
+# Prepended to every object key, e.g. "images/".
+S3_PREFIX = _env_str("S3_PREFIX", "")
+# For S3-compatible services such as MinIO, e.g. http://minio:9000.
+S3_ENDPOINT_URL = _env_str("S3_ENDPOINT_URL", "")
+S3_REGION = _env_str("S3_REGION", "us-east-1")
+# Base URL of a public bucket or a CDN in front of it; without one, clients
+# get presigned URLs valid for S3_PRESIGN_SECONDS.
+S3_PUBLIC_URL = _env_str("S3_PUBLIC_URL", "")
+S3_PRESIGN_SECONDS = _env_int("S3_PRESIGN_SECONDS", 3600)
+S3_MAX_CONNECTIONS = _env_int("S3_MAX_CONNECTIONS", 32)
+# Files larger than this are uploaded in parts of this size, S3_UPLOAD_THREADS at a time.
+S3_MULTIPART_BYTES = _env_int("S3_MULTIPART_BYTES", 16 * 1024**2)
+S3_UPLOAD_THREADS = _env_int("S3_UPLOAD_THREADS", 4)
+
+# --- Storage Maintenance ---
+# Seconds between background maintenance runs; 0 disables them (run
+# `python -m backend.maintenance` from cron instead).
+MAINTENANCE_INTERVAL = _env_int("MAINTENANCE_INTERVAL", 3600)
+# Days an artifact may go unused before it is deleted; 0 keeps it until its
+# size budget evicts it (or, for originals, forever).
+RETAIN_SHRUNK_DAYS = _env_int("RETAIN_SHRUNK_DAYS", 0)
+RETAIN_UPSCALED_DAYS = _env_int("RETAIN_UPSCALED_DAYS", 7)
+RETAIN_ORIGINALS_DAYS = _env_int("RETAIN_ORIGINALS_DAYS", 0)
+# Total bytes of originals (live and archived) kept before the least
+# recently used are deleted, with everything derived from them; 0 is unlimited.
+ORIGINALS_QUOTA_BYTES = _env_int("ORIGINALS_QUOTA_BYTES", 0)
+# Originals unused for this many days are moved into a zip pack under
+# .archive and extracted again on their next use; 0 disables archiving.
+ARCHIVE_ORIGINALS_DAYS = _env_int("ARCHIVE_ORIGINALS_DAYS", 0)
+# Largest pack one maintenance run writes; the rest waits for the next run.
+ARCHIVE_PACK_BYTES = _env_int("ARCHIVE_PACK_BYTES", 1024**3)
+# Packs with less than this percentage of their bytes still referenced are rewritten.
+ARCHIVE_COMPACT_PERCENT = _env_int("ARCHIVE_COMPACT_PERCENT", 50)
+
+# --- Upload Limits ---
+MAX_UPLOAD_BYTES = _env_int("MAX_UPLOAD_BYTES", 50 * 1024**2)
+# Checked against the image header before anything is decoded.
+MAX_IMAGE_PIXELS = _env_int("MAX_IMAGE_PIXELS", 100_000_000)
+UPLOAD_CHUNK_BYTES = _env_int("UPLOAD_CHUNK_BYTES", 1024**2)
+# Most images (files plus archive members) accepted by one /shrink/batch call.
+MAX_BATCH_ITEMS = _env_int("MAX_BATCH_ITEMS", 1000)
+
+# --- Near-duplicate Detection ---
+# What to do when a new upload looks like a stored original (same photo
+# re-saved, resized or converted): "report" lists the matches in the
+# response, "link" also points the upload's file key at the stored original
+# instead of storing and shrinking it again, as long as that original is at
+# least as large and of the same format; "off" skips the lookup.
+NEAR_DUPLICATES = _env_str("NEAR_DUPLICATES", "report")
+# Most bits of the 64-bit perceptual hash in which near-duplicates may
+# differ, at most 7; unrelated photos typically differ in 20 or more.
+NEAR_DUPLICATE_DISTANCE = _env_int("NEAR_DUPLICATE_DISTANCE", 5)
+if NEAR_DUPLICATES not in ("off", "report", "link"):
+    raise RuntimeError(f"NEAR_DUPLICATES must be off, report or link, got {NEAR_DUPLICATES!r}")
+if not 0 <= NEAR_DUPLICATE_DISTANCE <= 7:
+    raise RuntimeError(f"NEAR_DUPLICATE_DISTANCE must be between 0 and 7, got {NEAR_DUPLICATE_DISTANCE}")
+
+# --- Upscale Jobs ---
+# Upscale jobs queued or running at once; beyond this /upscale returns 503.
+UPSCALE_JOB_QUEUE = _env_int("UPSCALE_JOB_QUEUE", 100)
+# Seconds a finished job stays available at GET /jobs/{id}.
+JOB_TTL = _env_int("JOB_TTL", 3600)
+
+# --- Decoding ---
+# Decode JPEGs at 1/2, 1/4 or 1/8 scale when every requested width allows it.
+REDUCED_DECODE = _env_int("REDUCED_DECODE", 1)
+
+# --- On-the-fly Resizing ---
+# Encoded /img renditions kept in memory in front of the on-disk derived cache.
+IMG_MEMORY_CACHE_BYTES = _env_int("IMG_MEMORY_CACHE_BYTES", 128 * 1024**2)
+# Cache-Control max-age for /img responses. A file key can be re-uploaded
+# with new content, so these are revalidated against their ETag afterwards.
+IMG_MAX_AGE = _env_int("IMG_MAX_AGE", 3600)
+
+# --- Metrics ---
+# Add a Server-Timing header with the per-stage durations to every response.
+# Off by default since it exposes internal timings to clients.
+SERVER_TIMING = _env_int("SERVER_TIMING", 0)
@@ -0,0 +1,648 @@
+"""Persistent SQLite index of everything under STORAGE_ROOT.
+
+`files` has one row per file key recording where its original, shrunk and
+upscaled artifacts live (paths relative to the storage root) together with
+their dimensions and sizes, so lookups never have to walk the dated folders.
+
+`derived` is the cache of generated artifacts such as shrunk renditions
+and upscales, keyed by everything that determines their bytes and evicted
+least recently used first. Both tables can always be rebuilt from what is
+on disk, including the archive packs old originals are moved into.
+
+`phashes` holds the perceptual hash of every stored original, split into
+bands for near-duplicate lookups (see backend.perceptual).
+
+`jobs` mirrors the state of recent upscale jobs so that any server process
+can answer for a job another one is running; it is never rebuilt.
+"""
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+from PIL import Image
+
+from .perceptual import BANDS, bands, distance, dhash_encoded, from_signed, to_signed
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the schema changes; older databases are dropped and rebuilt.
+SCHEMA_VERSION = 7
+
+COLUMNS = (
+    "content_hash", "rotate",
+    "original_path", "original_width", "original_height", "original_size", "original_archive",
+    "shrunk_path", "shrunk_width", "shrunk_height", "shrunk_size",
+    "upscaled_path", "upscaled_size",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_key TEXT PRIMARY KEY,
+    content_hash TEXT,
+    rotate INTEGER NOT NULL DEFAULT 0,
+    original_path TEXT,
+    original_width INTEGER,
+    original_height INTEGER,
+    original_size INTEGER,
+    original_archive TEXT,
+    shrunk_path TEXT,
+    shrunk_width INTEGER,
+    shrunk_height INTEGER,
+    shrunk_size INTEGER,
+    upscaled_path TEXT,
+    upscaled_size INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash, rotate);
+CREATE INDEX IF NOT EXISTS files_original_path ON files (original_path);
+
+CREATE TABLE IF NOT EXISTS derived (
+    cache_key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    path TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    quality INTEGER,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS derived_last_access ON derived (last_access);
+CREATE INDEX IF NOT EXISTS derived_content_hash ON derived (content_hash);
+
+-- One row per band of each original's perceptual hash.
+CREATE TABLE IF NOT EXISTS phashes (
+    content_hash TEXT NOT NULL,
+    rotate INTEGER NOT NULL,
+    band INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    PRIMARY KEY (content_hash, rotate, band)
+);
+CREATE INDEX IF NOT EXISTS phashes_band ON phashes (band, value);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# originals/<hash>[-r<angle>]/<file_key>
+ORIGINAL_DIR_RE = re.compile(r"^(?P<hash>[0-9a-f]{64})(?:-r(?P<rotate>90|180|270))?$")
+# shrunk/<hash>[-r<angle>]_w<width>_<spec>.<ext>, where spec is a QualityTarget
+# token: q<quality>, b<max bytes>, s<min ssim> or p<min psnr>, or "lossless"
+# for formats without a quality setting.
+SHRUNK_NAME_RE = re.compile(
+    r"^(?P<hash>[0-9a-f]{64})(?:-r(?P<rotate>90|180|270))?_w(?P<width>\d+)"
+    r"_(?P<spec>q\d+|b\d+|s[\d.]+|p[\d.]+|lossless)\.(?P<ext>webp|jpg|png|avif)$"
+)
+# upscaled/<hash>[-r<angle>][_<source>]_<engine>.<ext>, where source names the
+# shrunk rendition it was upscaled from (w<width>-<spec>-<ext>) and is left
+# out when the original itself was enhanced.
+UPSCALED_NAME_RE = re.compile(
+    r"^(?P<hash>[0-9a-f]{64})(?:-r(?P<rotate>90|180|270))?"
+    r"(?:_(?P<source>w\d+-(?:q\d+|b\d+|s[\d.]+|p[\d.]+)-[a-z]+))?_(?P<engine>[a-z0-9]+)\.(?P<ext>\w+)$"
+)
+FORMAT_EXTENSIONS = {"webp": "webp", "jpeg": "jpg", "png": "png", "avif": "avif"}
+# .archive/originals-<stamp>.zip, holding <original dir>/<file name> members
+# plus a manifest.json mapping each member to the file keys that used it.
+ARCHIVE_DIR = ".archive"
+ARCHIVE_MANIFEST = "manifest.json"
+
+
+def hash_bytes(content) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def original_dirname(content_hash: str, rotate: int) -> str:
+    """Originals are stored per (upload hash, rotation) so identical uploads share one copy."""
+    return f"{content_hash}-r{rotate}" if rotate else content_hash
+
+
+def shrink_cache_key(content_hash: str, rotate: int, width: int, spec: str,
+                     fmt: str = "webp") -> str:
+    return f"shrink:{original_dirname(content_hash, rotate)}:{width}:{spec}:{fmt}"
+
+
+def shrunk_filename(content_hash: str, rotate: int, width: int, spec: str,
+                    fmt: str = "webp") -> str:
+    return f"{original_dirname(content_hash, rotate)}_w{width}_{spec}.{FORMAT_EXTENSIONS[fmt]}"
+
+
+def upscaled_filename(content_hash: str, rotate: int, engine: str, extension: str,
+                      source: str | None = None) -> str:
+    source_part = f"_{source}" if source else ""
+    return f"{original_dirname(content_hash, rotate)}{source_part}_{engine}{extension}"
+
+
+def upscale_cache_key(content_hash: str, rotate: int, engine: str, extension: str,
+                      source: str | None = None) -> str:
+    return f"upscale:{original_dirname(content_hash, rotate)}:{source or 'original'}:{engine}:{extension}"
+
+
+def upscale_source_token(shrunk_name: str) -> str | None:
+    """The part of an upscaled file name that identifies the rendition it was made from."""
+    match = SHRUNK_NAME_RE.match(shrunk_name)
+    return f"w{match['width']}-{match['spec']}-{match['ext']}" if match else None
+
+
+ORIENTATION_TAG = 0x0112
+# EXIF orientations that swap width and height.
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def _image_size(path):
+    """(width, height) as OpenCV decodes the image, i.e. with EXIF orientation applied."""
+    # Only the header is parsed, the pixels are never decoded.
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            if img.getexif().get(ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None, None
+
+
+class StorageIndex:
+    """Thread-safe wrapper around the index database."""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Other server processes may hold the write lock for a while, e.g. during a rebuild.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # One transaction, so processes starting together migrate the schema once.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                # The index only mirrors the disk, so an outdated one is simply
+                # dropped; startup sees it empty and rebuilds it.
+                for table in ("files", "derived", "phashes", "jobs"):
+                    self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self._conn.execute(statement)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def get(self, file_key: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM files WHERE file_key = ?", (file_key,)).fetchone()
+        return dict(row) if row else None
+
+    def find_by_hash(self, content_hash: str, rotate: int | None = None) -> list[dict]:
+        query = "SELECT * FROM files WHERE content_hash = ?"
+        params: list = [content_hash]
+        if rotate is not None:
+            query += " AND rotate = ?"
+            params.append(rotate)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY updated_at DESC", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def uses_original(self, original_path: str) -> bool:
+        """Whether any file key's row points at original_path."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM files WHERE original_path = ? LIMIT 1", (original_path,)
+            ).fetchone()
+        return row is not None
+
+    def update(self, file_key: str, **fields):
+        """Inserts or updates the row for file_key, touching only the given columns."""
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown index columns: {sorted(unknown)}")
+        names = list(fields) + ["updated_at"]
+        values = list(fields.values()) + [time.time()]
+        assignments = ", ".join(f"{name} = excluded.{name}" for name in names)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO files (file_key, {', '.join(names)}) "
+                f"VALUES (?, {', '.join('?' for _ in names)}) "
+                f"ON CONFLICT (file_key) DO UPDATE SET {assignments}",
+                [file_key, *values],
+            )
+
+    # --- Perceptual hashes ---
+
+    def _phash_rows(self, content_hash: str, rotate: int, phash: int) -> list[tuple]:
+        signed = to_signed(phash)
+        return [(content_hash, rotate, band, value, signed) for band, value in enumerate(bands(phash))]
+
+    def put_phash(self, content_hash: str, rotate: int, phash: int):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO phashes (content_hash, rotate, band, value, phash) VALUES (?, ?, ?, ?, ?)",
+                self._phash_rows(content_hash, rotate, phash),
+            )
+
+    def near_duplicates(self, phash: int, max_distance: int) -> list[dict]:
+        """Stored originals whose perceptual hash is within max_distance bits of phash.
+
+        Each match has the content_hash and rotate of the original, the
+        newest file key using it with its path and dimensions, and the
+        distance; closest first.
+        """
+        clauses = " OR ".join("(band = ? AND value = ?)" for _ in range(BANDS))
+        params = [param for band, value in enumerate(bands(phash)) for param in (band, value)]
+        with self._lock:
+            candidates = self._conn.execute(
+                f"SELECT DISTINCT content_hash, rotate, phash FROM phashes WHERE {clauses}", params
+            ).fetchall()
+            matches = []
+            for row in candidates:
+                bits = distance(phash, from_signed(row["phash"]))
+                if bits > max_distance:
+                    continue
+                # Rows of deleted originals linger until maintenance purges them.
+                newest = self._conn.execute(
+                    "SELECT file_key, original_path, original_width, original_height FROM files "
+                    "WHERE content_hash = ? AND rotate = ? ORDER BY updated_at DESC LIMIT 1",
+                    (row["content_hash"], row["rotate"]),
+                ).fetchone()
+                if newest:
+                    matches.append({
+                        "content_hash": row["content_hash"], "rotate": row["rotate"],
+                        **dict(newest), "distance": bits,
+                    })
+        return sorted(matches, key=lambda match: match["distance"])
+
+    def purge_phashes(self) -> int:
+        """Drops the hashes of originals no file key uses any more; returns how many."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM phashes WHERE NOT EXISTS (SELECT 1 FROM files "
+                "WHERE files.content_hash = phashes.content_hash AND files.rotate = phashes.rotate)"
+            )
+        return cursor.rowcount // BANDS
+
+    # --- Derived artifact cache ---
+
+    def get_derived(self, cache_key: str) -> dict | None:
+        """Returns a cached artifact and marks it as recently used."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM derived WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE derived SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key)
+                )
+        return dict(row) if row else None
+
+    def put_derived(self, cache_key: str, kind: str, content_hash: str, path: str,
+                    width: int | None, height: int | None, size: int, quality: int | None = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO derived "
+                "(cache_key, kind, content_hash, path, width, height, quality, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (cache_key, kind, content_hash, path, width, height, quality, size, time.time()),
+            )
+
+    def delete_derived(self, cache_key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM derived WHERE cache_key = ?", (cache_key,))
+
+    def pop_lru_derived(self, budget: int, kind: str = "shrink") -> list[str]:
+        """Drops least recently used artifacts of kind until their total fits in budget.
+
+        Returns the relative paths of the dropped artifacts for the caller to delete.
+        """
+        removed = []
+        with self._lock:
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM derived WHERE kind = ?", (kind,)
+            ).fetchone()[0]
+            if total <= budget:
+                return removed
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row in self._conn.execute(
+                    "SELECT cache_key, path, size FROM derived WHERE kind = ? ORDER BY last_access", (kind,)
+                ).fetchall():
+                    if total <= budget:
+                        break
+                    self._conn.execute("DELETE FROM derived WHERE cache_key = ?", (row["cache_key"],))
+                    total -= row["size"]
+                    removed.append(row["path"])
+                self._forget_derived(removed)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return removed
+
+    def pop_stale_derived(self, kind: str, cutoff: float) -> list[str]:
+        """Drops artifacts of kind not used since cutoff; returns their relative paths."""
+        return self._pop_derived("kind = ? AND last_access < ?", (kind, cutoff))
+
+    def pop_derived_for(self, content_hash: str) -> list[str]:
+        """Drops every artifact made from content_hash; returns their relative paths."""
+        return self._pop_derived("content_hash = ?", (content_hash,))
+
+    def _pop_derived(self, where: str, params: tuple) -> list[str]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = [row["path"] for row in self._conn.execute(
+                    f"SELECT path FROM derived WHERE {where}", params
+                ).fetchall()]
+                self._conn.execute(f"DELETE FROM derived WHERE {where}", params)
+                self._forget_derived(removed)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return removed
+
+    def _forget_derived(self, paths: list[str]):
+        # Keeps files rows from pointing at artifacts that are about to be deleted.
+        for path in paths:
+            self._conn.execute(
+                "UPDATE files SET shrunk_path = NULL, shrunk_width = NULL, shrunk_height = NULL, "
+                "shrunk_size = NULL WHERE shrunk_path = ?", (path,),
+            )
+            self._conn.execute(
+                "UPDATE files SET upscaled_path = NULL, upscaled_size = NULL WHERE upscaled_path = ?", (path,)
+            )
+
+    def derived_last_access(self) -> dict[str, float]:
+        """When anything made from each content hash was last used."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_hash, MAX(last_access) FROM derived GROUP BY content_hash"
+            ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    # --- Originals ---
+
+    def originals(self) -> list[dict]:
+        """Every row with a stored original, live or archived."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT file_key, content_hash, rotate, original_path, original_size, original_archive, "
+                "updated_at FROM files WHERE original_path IS NOT NULL"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_archived(self, file_key: str, live_path: str, updated_at: float,
+                      archive: str, member: str) -> bool:
+        """Points file_key at member of archive, unless the row changed since it was read."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE files SET original_path = ?, original_archive = ? "
+                "WHERE file_key = ? AND original_path = ? AND updated_at = ? AND original_archive IS NULL",
+                (member, archive, file_key, live_path, updated_at),
+            )
+        return cursor.rowcount == 1
+
+    def delete_files(self, rows: list[tuple[str, float]]) -> list[str]:
+        """Deletes (file_key, updated_at) rows that have not changed since they were read.
+
+        Returns the keys actually deleted.
+        """
+        deleted = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for file_key, updated_at in rows:
+                    cursor = self._conn.execute(
+                        "DELETE FROM files WHERE file_key = ? AND updated_at = ?", (file_key, updated_at)
+                    )
+                    if cursor.rowcount:
+                        deleted.append(file_key)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted
+
+    def archive_members(self, archive: str) -> set[str]:
+        """Members of archive that index rows still point at."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT original_path FROM files WHERE original_archive = ?", (archive,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def move_archive(self, old: str, new: str):
+        with self._lock:
+            self._conn.execute("UPDATE files SET original_archive = ? WHERE original_archive = ?", (new, old))
+
+    # --- Jobs ---
+
+    def put_job(self, job: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, data, updated_at) VALUES (?, ?, ?)",
+                (job["job_id"], json.dumps(job), time.time()),
+            )
+
+    def get_job(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def purge_jobs(self, cutoff: float) -> int:
+        """Forgets jobs last updated before cutoff; returns how many."""
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,)).rowcount
+
+    # --- Rebuild ---
+
+    def rebuild(self, root: Path):
+        """Replaces the index with what is currently on disk under root.
+
+        When the same file key exists under several dated folders, the newest
+        one wins, matching what a fresh upload would have recorded.
+        """
+        started = time.monotonic()
+        rows: dict[str, dict] = {}
+        # Perceptual hash per original, computed once for all keys sharing it.
+        phashes: dict[tuple, int | None] = {}
+        # Dated folder names sort chronologically, so later entries overwrite.
+        for path in sorted(root.glob("*/originals/**/*")):
+            if path.name.startswith(".") or not path.is_file():
+                continue
+            match = ORIGINAL_DIR_RE.match(path.parent.name)
+            if match:
+                content_hash, rotate = match["hash"], int(match["rotate"] or 0)
+            elif path.parent.name == "originals":
+                # Flat layout written before uploads were content-addressed.
+                content_hash, rotate = hash_file(path), 0
+            else:
+                continue
+            width, height = _image_size(path)
+            if (content_hash, rotate) not in phashes:
+                phashes[(content_hash, rotate)] = dhash_encoded(str(path))
+            rows[path.name] = {
+                "content_hash": content_hash,
+                "rotate": rotate,
+                "original_path": path.relative_to(root).as_posix(),
+                "original_width": width,
+                "original_height": height,
+                "original_size": path.stat().st_size,
+                "updated_at": path.stat().st_mtime,
+            }
+
+        # Archived originals, for keys that have no live copy. Packs are named
+        # by creation time, so a key in several packs ends up with the newest.
+        for pack in sorted((root / ARCHIVE_DIR).glob("originals-*.zip")):
+            try:
+                with zipfile.ZipFile(pack) as zf:
+                    manifest = json.loads(zf.read(ARCHIVE_MANIFEST))
+                    for member, keys in manifest.items():
+                        match = ORIGINAL_DIR_RE.match(Path(member).parent.name)
+                        keys = [key for key in keys if key not in rows or rows[key].get("original_archive")]
+                        if not match or not keys:
+                            continue
+                        with zf.open(member) as f:
+                            width, height = _image_size(f)
+                        original = (match["hash"], int(match["rotate"] or 0))
+                        if original not in phashes:
+                            phashes[original] = dhash_encoded(zf.read(member))
+                        for key in keys:
+                            rows[key] = {
+                                "content_hash": match["hash"],
+                                "rotate": int(match["rotate"] or 0),
+                                "original_path": member,
+                                "original_archive": pack.relative_to(root).as_posix(),
+                                "original_width": width,
+                                "original_height": height,
+                                "original_size": zf.getinfo(member).file_size,
+                                "updated_at": pack.stat().st_mtime,
+                            }
+            except (KeyError, ValueError, zipfile.BadZipFile):
+                logger.warning("Skipping unreadable archive %s", pack)
+
+        keys_by_stem: dict[str, list[str]] = {}
+        keys_by_original: dict[tuple, list[str]] = {}
+        for key, fields in rows.items():
+            keys_by_stem.setdefault(Path(key).stem, []).append(key)
+            keys_by_original.setdefault((fields["content_hash"], fields["rotate"]), []).append(key)
+
+        derived = []
+        # Hidden names are temporary files of writes in progress.
+        shrunk_files = sorted(root.glob("*/shrunk/[!.]*.*"), key=lambda p: p.stat().st_mtime)
+        for path in shrunk_files:
+            width, height = _image_size(path)
+            relative = path.relative_to(root).as_posix()
+            size = path.stat().st_size
+            match = SHRUNK_NAME_RE.match(path.name)
+            if match:
+                content_hash, rotate = match["hash"], int(match["rotate"] or 0)
+                fmt = next(name for name, ext in FORMAT_EXTENSIONS.items() if ext == match["ext"])
+                spec = match["spec"]
+                cache_key = shrink_cache_key(content_hash, rotate, int(match["width"]), spec, fmt)
+                # Only a fixed-quality spec says which quality was used.
+                quality = int(spec[1:]) if spec.startswith("q") else None
+                derived.append((cache_key, "shrink", content_hash, relative, width, height, quality,
+                                size, path.stat().st_mtime))
+                keys = keys_by_original.get((content_hash, rotate), [])
+            elif path.suffix == ".webp":
+                keys = keys_by_stem.get(path.stem, [])
+            else:
+                continue
+            # Files are visited oldest first, so each key ends up with its newest shrink.
+            for key in keys:
+                rows[key].update(
+                    shrunk_path=relative, shrunk_width=width, shrunk_height=height, shrunk_size=size,
+                )
+
+        for path in sorted(root.glob("*/upscaled/[!.]*")):
+            relative = path.relative_to(root).as_posix()
+            stat = path.stat()
+            match = UPSCALED_NAME_RE.match(path.name)
+            if match:
+                content_hash, rotate = match["hash"], int(match["rotate"] or 0)
+                keys = keys_by_original.get((content_hash, rotate), [])
+                cache_key = upscale_cache_key(content_hash, rotate, match["engine"], f".{match['ext']}",
+                                              match["source"])
+            elif path.name.startswith("upscaled_"):
+                # Named after the file key before upscales were content-addressed.
+                keys = [path.name[len("upscaled_"):]]
+                content_hash = rows.get(keys[0], {}).get("content_hash") or ""
+                # Never looked up, but still subject to upscale retention and quota.
+                cache_key = f"upscale:legacy:{relative}"
+            else:
+                continue
+            width, height = _image_size(path)
+            derived.append((cache_key, "upscale", content_hash, relative, width, height, None,
+                            stat.st_size, stat.st_mtime))
+            for key in keys:
+                if key in rows:
+                    rows[key].update(upscaled_path=relative, upscaled_size=stat.st_size)
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM files")
+                self._conn.execute("DELETE FROM derived")
+                self._conn.execute("DELETE FROM phashes")
+                for key, fields in rows.items():
+                    record = {name: fields.get(name) for name in COLUMNS}
+                    record["rotate"] = record["rotate"] or 0
+                    self._conn.execute(
+                        f"INSERT INTO files (file_key, {', '.join(COLUMNS)}, updated_at) "
+                        f"VALUES (?, {', '.join('?' for _ in COLUMNS)}, ?)",
+                        [key, *record.values(), fields.get("updated_at", now)],
+                    )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO derived "
+                    "(cache_key, kind, content_hash, path, width, height, quality, size, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    derived,
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO phashes (content_hash, rotate, band, value, phash) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        phash_row for (content_hash, rotate), phash in phashes.items() if phash is not None
+                        for phash_row in self._phash_rows(content_hash, rotate, phash)
+                    ],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info("Rebuilt storage index with %d files in %.1fs", len(rows), time.monotonic() - started)
+        return len(rows)
+
+
+if __name__ == "__main__":
+    # python -m backend.index  -> rebuild the index from disk
+    from .storage import STORAGE_ROOT, index
+
+    logging.basicConfig(level=logging.INFO)
+    print(f"Indexed {index.rebuild(STORAGE_ROOT)} files under {STORAGE_ROOT}")
@@ -0,0 +1,163 @@
+"""Bounded upload ingest.
+
+Uploads are read in chunks, hashed as they arrive and rejected as soon as
+they exceed the configured byte limit or their header announces more pixels
+than allowed, so oversized images never reach the decoder.
+"""
+import hashlib
+import io
+import tarfile
+import zipfile
+from functools import partial
+from pathlib import Path
+
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image
+
+from . import config, metrics
+
+# Enough for the header of every format we accept, including large EXIF blocks.
+HEADER_PROBE_BYTES = 256 * 1024
+
+# Pillow's own decompression bomb guard follows the same limit: it warns
+# above it and refuses to even open images of more than twice as many pixels.
+Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS
+
+
+def probe_dimensions(data):
+    """Returns (width, height) from the image header, or None if not parseable yet.
+
+    Raises a 413 for headers Pillow refuses as decompression bombs; those are
+    far over the pixel limit and must not be mistaken for unknown sizes.
+    """
+    try:
+        # Image.open only parses the header; no pixel data is decoded.
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Image.DecompressionBombError:
+        raise HTTPException(
+            status_code=413, detail=f"Image is larger than the {config.MAX_IMAGE_PIXELS} pixel limit"
+        )
+    except Exception:
+        return None
+
+
+def check_pixels(width: int, height: int):
+    if width * height > config.MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is {width}x{height}, larger than the {config.MAX_IMAGE_PIXELS} pixel limit",
+        )
+
+
+async def read_upload(file: UploadFile):
+    """Reads an upload in chunks, enforcing the size and pixel limits.
+
+    Returns (content, sha256 hex digest).
+    """
+    with metrics.timed("read"):
+        content = bytearray()
+        digest = hashlib.sha256()
+        probed = False
+        while True:
+            chunk = await file.read(config.UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            content += chunk
+            digest.update(chunk)
+            if len(content) > config.MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Upload exceeds the {config.MAX_UPLOAD_BYTES} byte limit",
+                )
+            if not probed and len(content) >= HEADER_PROBE_BYTES:
+                size = probe_dimensions(content)
+                if size:
+                    check_pixels(*size)
+                    probed = True
+
+        if not probed:
+            size = probe_dimensions(content)
+            if size:
+                check_pixels(*size)
+    metrics.BYTES_IN.inc(len(content))
+    return content, digest.hexdigest()
+
+
+# --- Batch Ingest ---
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz")
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def list_archive(fileobj, filename: str):
+    """Returns [(member_name, size, read)] for the images inside a zip or tar archive."""
+    members = []
+    if filename.lower().endswith(".zip"):
+        archive = zipfile.ZipFile(fileobj)
+        for info in archive.infolist():
+            if not info.is_dir():
+                members.append((info.filename, info.file_size, partial(archive.read, info)))
+    else:
+        archive = tarfile.open(fileobj=fileobj, mode="r:*")
+        for member in archive.getmembers():
+            if member.isfile():
+                members.append((member.name, member.size, partial(_read_tar_member, archive, member)))
+    return [m for m in members if Path(m[0]).suffix.lower() in IMAGE_SUFFIXES]
+
+
+def _read_tar_member(archive, member):
+    with archive.extractfile(member) as f:
+        return f.read()
+
+
+def load_member(read, size: int):
+    """Reads one archive member under the same limits as a single upload."""
+    if size > config.MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload exceeds the {config.MAX_UPLOAD_BYTES} byte limit",
+        )
+    content = read()
+    metrics.BYTES_IN.inc(len(content))
+    dimensions = probe_dimensions(content)
+    if dimensions:
+        check_pixels(*dimensions)
+    return content, hashlib.sha256(content).hexdigest()
+
+
+async def iter_batch_items(files: list[UploadFile]):
+    """Yields (position, (filename, (content, sha256) or HTTPException)) per image.
+
+    Archives are expanded in place. Items are read one at a time, so memory
+    is bounded by how far the caller lets this generator run ahead.
+    """
+    position = 0
+    for upload in files:
+        if is_archive(upload.filename):
+            try:
+                members = await run_in_threadpool(list_archive, upload.file, upload.filename)
+            except (zipfile.BadZipFile, tarfile.TarError) as e:
+                error = HTTPException(status_code=400, detail=f"Invalid archive: {e}")
+                yield position, (upload.filename, error)
+                position += 1
+                continue
+            for name, size, read in members:
+                try:
+                    loaded = await run_in_threadpool(load_member, read, size)
+                except HTTPException as e:
+                    loaded = e
+                yield position, (name, loaded)
+                position += 1
+        else:
+            try:
+                loaded = await read_upload(upload)
+            except HTTPException as e:
+                loaded = e
+            yield position, (upload.filename, loaded)
+            position += 1
@@ -0,0 +1,175 @@
+"""In-process job queue for long-running work such as upscaling.
+
+Jobs are submitted with a key and a priority and return immediately. A fixed
+number of asyncio workers drain the queue highest priority first, so the
+concurrency limit holds no matter how many jobs are waiting. Submitting a key
+that is already queued or running returns the existing job instead of
+starting the same work twice.
+
+Jobs live in the process that runs them. Every change of state is also
+handed to an optional store, in order, so that other server processes can
+report on jobs they did not start.
+"""
+import asyncio
+import contextvars
+import itertools
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+from . import config, metrics
+from .storage import index
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, key: str, run, priority: int):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.priority = priority
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.result: dict | None = None
+        self.error: str | None = None
+        self.status_code: int | None = None
+        self._run = run
+        self._done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    async def wait(self):
+        await self._done.wait()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "key": self.key,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+            "status_code": self.status_code,
+        }
+
+
+class JobQueue:
+    def __init__(self, name: str, concurrency: int, max_pending: int, ttl: int, store=None):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.store = store
+        self._jobs: dict[str, Job] = {}
+        self._in_flight: dict[str, Job] = {}
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._order = itertools.count()
+        self._depth_gauge = metrics.JOB_QUEUE_DEPTH.labels(name)
+        # One thread, so the store sees each job's states in the order they happened.
+        self._publisher: ThreadPoolExecutor | None = None
+
+    def _ensure_started(self):
+        if not self._workers:
+            self._queue = asyncio.PriorityQueue()
+            # Workers outlive the request that starts them, so they get a
+            # fresh context instead of inheriting that request's one.
+            self._workers = [
+                asyncio.create_task(self._worker(), context=contextvars.Context())
+                for _ in range(self.concurrency)
+            ]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._publisher is not None:
+            self._publisher.shutdown(wait=True)
+            self._publisher = None
+
+    @property
+    def depth(self) -> int:
+        """Jobs currently queued or running."""
+        return len(self._in_flight)
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def submit(self, key: str, run, priority: int = 0):
+        """Queues `await run()` under key; returns (job, created).
+
+        Raises a 503 when max_pending jobs are already queued or running.
+        """
+        self._ensure_started()
+        self._purge_expired()
+        existing = self._in_flight.get(key)
+        if existing is not None:
+            return existing, False
+        if len(self._in_flight) >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail=f"The {self.name} queue is full, please retry shortly.",
+                headers={"Retry-After": str(config.RETRY_AFTER)},
+            )
+        job = Job(key, run, priority)
+        self._jobs[job.id] = job
+        self._in_flight[key] = job
+        self._depth_gauge.inc()
+        self._publish(job)
+        # Highest priority first, then first come first served.
+        self._queue.put_nowait((-priority, next(self._order), job))
+        return job, True
+
+    def _publish(self, job: Job):
+        if self.store is None:
+            return
+        if self._publisher is None:
+            self._publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-jobs")
+        # Snapshot now; the write happens off the event loop.
+        self._publisher.submit(self.store, job.to_dict())
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            job.status = RUNNING
+            job.started_at = time.time()
+            self._publish(job)
+            try:
+                job.result = await job._run()
+                job.status = SUCCEEDED
+            except HTTPException as e:
+                job.status, job.error, job.status_code = FAILED, e.detail, e.status_code
+            except Exception as e:
+                job.status, job.error, job.status_code = FAILED, str(e), 500
+            finally:
+                job.finished_at = time.time()
+                metrics.JOBS.labels(self.name, job.status).inc()
+                self._in_flight.pop(job.key, None)
+                self._depth_gauge.dec()
+                self._publish(job)
+                job._done.set()
+
+
+upscale_jobs = JobQueue(
+    "upscale", config.UPSCALE_WORKERS, config.UPSCALE_JOB_QUEUE, config.JOB_TTL, store=index.put_job
+)
@@ -1,158 +1,736 @@
-import os
-from datetime import datetime
+import asyncio
+import json
+import logging
+import mimetypes
+import time
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, Query, HTTPException
-from fastapi.staticfiles import StaticFiles
-import cv2
-import subprocess
-
-app = FastAPI()
-
-# --- 1. Storage Configuration ---
-if os.path.exists("/.dockerenv"):
-    STORAGE_ROOT = Path("/app/storage")
-else:
-    STORAGE_ROOT = Path(__file__).parent.parent / "storage"
-
-STORAGE_ROOT.mkdir(parents=True, exist_ok=True)
-app.mount("/view_storage", StaticFiles(directory=STORAGE_ROOT), name="storage")
-
-# --- Helper Functions ---
-
-def apply_rotation(img, angle: int):
-    """Rotates the image by 90, 180, or 270 degrees clockwise."""
-    if angle == 90:
-        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-    elif angle == 180:
-        return cv2.rotate(img, cv2.ROTATE_180)
-    elif angle == 270:
-        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-    return img
-
-def get_storage_path(subfolder: str):
-    today = datetime.now().strftime("%Y-%m-%d")
-    path = STORAGE_ROOT / today / subfolder
-    path.mkdir(parents=True, exist_ok=True)
-    return path
-
-def find_original_file(filename: str):
-    matches = list(STORAGE_ROOT.glob(f"**/originals/{filename}"))
-    return matches[0] if matches else None
+from fastapi import BackgroundTasks, Depends, FastAPI, Request, UploadFile, File, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from . import config, metrics
+from .codecs import CodecError, QualityTarget, get_codec
+from .index import (
+    original_dirname,
+    shrink_cache_key,
+    shrunk_filename,
+    upscale_cache_key,
+    upscale_source_token,
+    upscaled_filename,
+)
+from .cache import rendition_cache, rendition_flights
+from .jobs import FAILED, upscale_jobs
+from .ingest import iter_batch_items, read_upload
+from .maintenance import run_maintenance
+from .upscaler import EngineUnavailable, load_engine
+from .pipeline import (
+    ImageError,
+    hash_upload,
+    shrink_stored,
+    shrink_upload,
+    upscale_stored,
+)
+from .storage import (
+    STORAGE_ROOT,
+    StorageFiles,
+    evict_derived,
+    find_derived,
+    find_original_file,
+    find_record,
+    find_shrunk_file,
+    get_storage_path,
+    index,
+    link_original,
+    locks,
+    publish,
+    read_derived,
+    rebuild_index_if_empty,
+    record_file,
+    relative_path,
+    storage_url,
+)
+from .workers import PoolFullError, shrink_pool, upscale_pool
+
+logger = logging.getLogger(__name__)
+
+
+async def maintenance_loop(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Every server process runs this loop; whichever comes first does the work.
+            await run_in_threadpool(run_maintenance, interval / 2)
+        except Exception:
+            logger.exception("Storage maintenance failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # A missing or fresh index is rebuilt from whatever is already on disk.
+    await run_in_threadpool(rebuild_index_if_empty)
+    # Load the upscaler weights once, before the first request needs them.
+    await run_in_threadpool(load_engine)
+    maintenance = None
+    if config.MAINTENANCE_INTERVAL > 0:
+        maintenance = asyncio.create_task(maintenance_loop(config.MAINTENANCE_INTERVAL))
+    yield
+    if maintenance is not None:
+        maintenance.cancel()
+    await upscale_jobs.stop()
+    shrink_pool.shutdown()
+    upscale_pool.shutdown()
+    index.close()
+    metrics.process_exiting()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/view_storage", StorageFiles(directory=STORAGE_ROOT), name="storage")
+
+# Room for the multipart boundaries and headers around a single file.
+MULTIPART_OVERHEAD = 64 * 1024
+# Endpoints taking exactly one uploaded file, whose whole body is bounded by MAX_UPLOAD_BYTES.
+SINGLE_UPLOAD_PATHS = {"/shrink", "/shrink/renditions"}
+
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    # Checked before the multipart body is parsed and spooled; uploads sent
+    # without a Content-Length are still capped chunk by chunk in read_upload.
+    if request.url.path in SINGLE_UPLOAD_PATHS:
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > config.MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Upload exceeds the {config.MAX_UPLOAD_BYTES} byte limit"},
+            )
+    return await call_next(request)
+
+
+def route_label(request: Request) -> str:
+    """The route template (not the raw path) so metric labels stay bounded."""
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    # Mounted apps such as /view_storage set root_path instead of a route.
+    return request.scope.get("root_path") or "unmatched"
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    # Registered last, so it wraps the other middleware and sees their responses too.
+    token = metrics.begin_request()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        stages = metrics.end_request(token)
+        route = route_label(request)
+        metrics.REQUEST_SECONDS.labels(request.method, route).observe(elapsed)
+        metrics.REQUESTS.labels(request.method, route, str(status)).inc()
+    if config.SERVER_TIMING:
+        # Streamed responses only include what ran before the first byte.
+        stages["total"] = elapsed
+        response.headers["Server-Timing"] = metrics.server_timing(stages)
+    return response
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.exposition(), media_type=CONTENT_TYPE_LATEST)
 
 # --- 2. Endpoints ---
+# OpenCV work runs on the bounded worker pools and index/disk lookups on the
+# default threadpool, so nothing blocking ever runs on the event loop.
+
+async def render_content(file_key: str, content, content_hash: str, targets, rotate: int,
+                         target: QualityTarget):
+    """Stores one upload and produces its renditions from a single decode.
+
+    targets is a list of (width, fmt), all encoded for the same quality
+    target. Renditions already in the derived cache
+    are reused; the rest are rendered together on the shrink pool. Returns
+    (original, renditions, created) where original describes the stored
+    original, renditions follow the order of targets, and created says
+    whether anything new was written (and the cache may need evicting).
+    original also lists the stored originals the upload resembles under
+    "near_duplicates", and under "linked_to" the file key whose original
+    it was linked to instead of being stored (see NEAR_DUPLICATES).
+    """
+    rotate = rotate if rotate in (90, 180, 270) else 0
+
+    # Uploads are content-addressed: identical bytes are stored once and a
+    # repeat (width, rotate, quality target, fmt) is answered from the derived cache.
+    with metrics.timed("lookup"):
+        original = await run_in_threadpool(link_original, file_key, content_hash, rotate)
+    near_duplicates, linked_to = [], None
+    if not original and config.NEAR_DUPLICATES == "link":
+        # Hash first, so a near-duplicate is never decoded in full or stored.
+        phash, size = await shrink_pool.run(hash_upload, content, rotate)
+        if phash is not None:
+            with metrics.timed("lookup"):
+                near_duplicates = await run_in_threadpool(
+                    index.near_duplicates, phash, config.NEAR_DUPLICATE_DISTANCE
+                )
+        upload_type = mimetypes.guess_type(file_key)[0]
+        for match in near_duplicates:
+            # Never trade an upload for a smaller version of itself.
+            if (match["original_width"] or 0) * (match["original_height"] or 0) < size[0] * size[1]:
+                continue
+            # The linked file keeps the upload's name, so its bytes must be in the format the name says.
+            if upload_type is None or mimetypes.guess_type(match["original_path"])[0] != upload_type:
+                continue
+            original = await run_in_threadpool(link_original, file_key, match["content_hash"], match["rotate"])
+            if original:
+                content_hash, rotate, linked_to = match["content_hash"], match["rotate"], match["file_key"]
+                metrics.NEAR_DUPLICATES.labels("linked").inc()
+                break
+    renditions = {}
+    if not original:
+        metrics.CACHE_LOOKUPS.labels("disk", "miss").inc(len(targets))
+    else:
+        for width, fmt in targets:
+            cache_key = shrink_cache_key(content_hash, rotate, width, target.spec_for(fmt), fmt)
+            with metrics.timed("lookup"):
+                cached = await run_in_threadpool(find_derived, cache_key)
+            metrics.CACHE_LOOKUPS.labels("disk", "hit" if cached else "miss").inc()
+            if cached:
+                renditions[(width, fmt)] = {
+                    "width": cached["width"], "height": cached["height"], "format": fmt,
+                    "quality": cached["quality"], "size": cached["size"], "path": cached["path"],
+                    "cached": True,
+                }
+
+    missing = list(dict.fromkeys(t for t in targets if t not in renditions))
+    written = []
+    phash = None
+    if missing:
+        shrunk_dir = get_storage_path("shrunk")
+        paths = {
+            (width, fmt): shrunk_dir / shrunk_filename(content_hash, rotate, width, target.spec_for(fmt), fmt)
+            for width, fmt in missing
+        }
+        jobs = [(width, fmt, str(paths[(width, fmt)])) for width, fmt in missing]
+        try:
+            if original:
+                result = await shrink_pool.run(
+                    shrink_stored, str(STORAGE_ROOT / original["original_path"]), jobs, target
+                )
+            else:
+                # The pipeline creates the content-addressed folder once the upload decodes.
+                file_path = get_storage_path("originals") / original_dirname(content_hash, rotate) / file_key
+                result = await shrink_pool.run(shrink_upload, content, str(file_path), jobs, rotate, target)
+                written.append(file_path)
+                phash = result["phash"]
+                original = {
+                    "original_path": relative_path(file_path),
+                    "original_width": result["original_width"],
+                    "original_height": result["original_height"],
+                    "original_size": result["original_size"],
+                }
+        except ImageError as e:
+            metrics.ERRORS.labels("shrink", str(e.status_code)).inc()
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+        metrics.observe_stages(result["timings"])
+        metrics.PIXELS.labels("shrink").inc(original["original_width"] * original["original_height"])
+        for (width, fmt), rendition in zip(missing, result["renditions"]):
+            metrics.BYTES_OUT.labels("shrink").inc(rendition["size"])
+            relative = relative_path(paths[(width, fmt)])
+            written.append(paths[(width, fmt)])
+            renditions[(width, fmt)] = {**rendition, "path": relative, "cached": False}
+            await run_in_threadpool(
+                index.put_derived, shrink_cache_key(content_hash, rotate, width, target.spec_for(fmt), fmt),
+                "shrink", content_hash, relative, rendition["width"], rendition["height"],
+                rendition["size"], rendition["quality"],
+            )
+
+    if written:
+        await run_in_threadpool(publish, *written)
+    # The file key points at the smallest rendition below the original's
+    # size, which /upscale restores; a full-size one has nothing to restore.
+    smaller = [renditions[t] for t in targets if renditions[t]["width"] < (original["original_width"] or 0)]
+    first = min(smaller, key=lambda r: r["width"]) if smaller else renditions[targets[0]]
+    await run_in_threadpool(
+        record_file, file_key, content_hash=content_hash, rotate=rotate,
+        original_path=original["original_path"],
+        original_width=original["original_width"],
+        original_height=original["original_height"],
+        original_size=original["original_size"],
+        # Always a live file by now, even if this key's previous original was archived.
+        original_archive=None,
+        shrunk_path=first["path"], shrunk_width=first["width"], shrunk_height=first["height"],
+        shrunk_size=first["size"],
+    )
+    if phash is not None:
+        # A new original: remember its hash, after its file row exists for maintenance to see.
+        if config.NEAR_DUPLICATES == "report":
+            with metrics.timed("lookup"):
+                near_duplicates = await run_in_threadpool(
+                    index.near_duplicates, phash, config.NEAR_DUPLICATE_DISTANCE
+                )
+        await run_in_threadpool(index.put_phash, content_hash, rotate, phash)
+        near_duplicates = [
+            match for match in near_duplicates
+            if (match["content_hash"], match["rotate"]) != (content_hash, rotate)
+        ]
+        if near_duplicates:
+            metrics.NEAR_DUPLICATES.labels("reported").inc()
+    original = {
+        **original, "linked_to": linked_to,
+        "near_duplicates": [
+            {"file_key": match["file_key"], "distance": match["distance"]} for match in near_duplicates
+        ],
+    }
+    return original, [renditions[t] for t in targets], bool(missing)
+
+
+async def shrink_content(file_key: str, content, content_hash: str, width: int, rotate: int,
+                         target: QualityTarget, fmt: str = "webp"):
+    """Shrinks one upload to a single rendition; shared by /shrink and /shrink/batch.
+
+    Returns (response, created) as for render_content.
+    """
+    original, (rendition,), created = await render_content(
+        file_key, content, content_hash, [(width, fmt)], rotate, target
+    )
+    response = {
+        "message": "File processed",
+        "relative_url": storage_url(rendition["path"]),
+        "width": rendition["width"],
+        "height": rendition["height"],
+        "savings": f"{original['original_size'] / rendition['size']:.1f}x smaller",
+        "format": fmt,
+        "quality": rendition["quality"],
+        "size": rendition["size"],
+        "cached": rendition["cached"],
+        "near_duplicates": original["near_duplicates"],
+        "linked_to": original["linked_to"],
+    }
+    return response, created
+
+
+def quality_target(quality: int = Query(80, ge=1, le=100), max_bytes: int | None = Query(None, gt=0),
+                   min_ssim: float | None = Query(None, gt=0, le=1),
+                   min_psnr: float | None = Query(None, gt=0)):
+    """Query parameters selecting a fixed quality or a size/fidelity goal."""
+    try:
+        return QualityTarget(quality, max_bytes, min_ssim, min_psnr)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_formats(formats: list[str], target: QualityTarget | None = None):
+    try:
+        for fmt in formats:
+            codec = get_codec(fmt)
+            if target is not None and target.has_goal and codec.quality_range is None:
+                raise CodecError(f"{fmt} has no quality setting, so max_bytes, min_ssim and min_psnr cannot apply")
+    except CodecError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
 @app.post("/shrink")
-async def process_image(file: UploadFile = File(...), width: int = 1280, rotate: int = 0):
-    orig_dir = get_storage_path("originals")
-    shrunk_dir = get_storage_path("shrunk")
+async def process_image(background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                        width: int = Query(1280, gt=0), rotate: int = 0,
+                        target: QualityTarget = Depends(quality_target),
+                        output_format: str = Query("webp", alias="format")):
+    check_formats([output_format], target)
+    shrink_pool.check_capacity()
+    content, content_hash = await read_upload(file)
+    response, created = await shrink_content(
+        Path(file.filename).name, content, content_hash, width, rotate, target, output_format
+    )
+    if created:
+        background_tasks.add_task(evict_derived)
+    return response
 
-    file_path = orig_dir / file.filename
-    shrunk_filename = f"{Path(file.filename).stem}.webp"
-    shrunk_path = shrunk_dir / shrunk_filename
 
-    # Save Uploaded File
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
+@app.post("/shrink/renditions")
+async def process_renditions(background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                             widths: list[int] = Query(...), formats: list[str] = Query(["webp"]),
+                             rotate: int = 0, target: QualityTarget = Depends(quality_target)):
+    """Produces every width x format rendition of one upload from a single decode."""
+    check_formats(formats, target)
+    if any(width <= 0 for width in widths):
+        raise HTTPException(status_code=400, detail="Widths must be positive")
 
-    # Load Image
-    img = cv2.imread(str(file_path))
-    if img is None:
-        raise HTTPException(status_code=400, detail="Invalid image file")
+    shrink_pool.check_capacity()
+    content, content_hash = await read_upload(file)
+    targets = list(dict.fromkeys((width, fmt) for width in widths for fmt in formats))
+    original, renditions, created = await render_content(
+        Path(file.filename).name, content, content_hash, targets, rotate, target
+    )
+    if created:
+        background_tasks.add_task(evict_derived)
+    return {
+        "message": "Renditions processed",
+        "original_url": storage_url(original["original_path"]),
+        "original_width": original["original_width"],
+        "original_height": original["original_height"],
+        "renditions": [
+            {
+                "relative_url": storage_url(r["path"]),
+                "width": r["width"],
+                "height": r["height"],
+                "format": r["format"],
+                "quality": r["quality"],
+                "size": r["size"],
+                "savings": f"{original['original_size'] / r['size']:.1f}x smaller",
+                "cached": r["cached"],
+            }
+            for r in renditions
+        ],
+        "near_duplicates": original["near_duplicates"],
+        "linked_to": original["linked_to"],
+    }
 
-    # 1. Apply Rotation if requested
-    if rotate in [90, 180, 270]:
-        img = apply_rotation(img, rotate)
-        # Overwrite the saved original with the rotated version
-        # This ensures future Upscaling uses the correct orientation
-        cv2.imwrite(str(file_path), img)
 
-    # 2. Process Shrink
-    orig_h, orig_w = img.shape[:2]
-    aspect_ratio = orig_h / orig_w
-    target_height = int(width * aspect_ratio)
+@app.post("/shrink/batch")
+async def process_batch(background_tasks: BackgroundTasks, files: list[UploadFile] = File(...),
+                        width: int = Query(1280, gt=0), rotate: int = 0,
+                        target: QualityTarget = Depends(quality_target),
+                        output_format: str = Query("webp", alias="format"), stream: bool = False):
+    """Shrinks many images (plain files and/or .zip/.tar archives) in one request.
 
-    shrunk_img = cv2.resize(img, (width, target_height), interpolation=cv2.INTER_AREA)
+    Items are processed concurrently on the shrink pool. Each result has the
+    same shape as a /shrink response plus its "filename", or an "error" and
+    "status_code" if that item failed. With stream=true, results are sent as
+    NDJSON lines in completion order; otherwise as one JSON list in input order.
+    """
+    check_formats([output_format], target)
+    # Cap concurrency at the pool's worker count so a batch never fills the
+    # queue that single /shrink requests rely on. Reading is bounded too: the
+    # producer stays at most that many items ahead of the workers.
+    concurrency = shrink_pool.max_workers
+    pending: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    finished: asyncio.Queue = asyncio.Queue()
 
-    # Write Shrunk WebP
-    success = cv2.imwrite(str(shrunk_path), shrunk_img, [cv2.IMWRITE_WEBP_QUALITY, 80])
+    async def produce():
+        try:
+            count = 0
+            async for position, item in iter_batch_items(files):
+                count += 1
+                if count > config.MAX_BATCH_ITEMS:
+                    await finished.put((position, item[0], HTTPException(
+                        status_code=413, detail=f"Batch exceeds {config.MAX_BATCH_ITEMS} items"
+                    )))
+                    break
+                await pending.put((position, item))
+        finally:
+            for _ in range(concurrency):
+                await pending.put(None)
 
-    if not success:
-        raise HTTPException(status_code=500, detail="OpenCV failed to write WebP.")
+    async def consume():
+        while (entry := await pending.get()) is not None:
+            position, (filename, loaded) = entry
+            try:
+                if isinstance(loaded, Exception):
+                    raise loaded
+                content, content_hash = loaded
+                while True:
+                    try:
+                        response, _ = await shrink_content(
+                            Path(filename).name, content, content_hash, width, rotate, target, output_format
+                        )
+                        break
+                    except PoolFullError:
+                        # Other requests filled the shared pool; batch items wait for it, not fail.
+                        await shrink_pool.wait_for_capacity()
+                await finished.put((position, filename, response))
+            except HTTPException as e:
+                metrics.ERRORS.labels("batch", str(e.status_code)).inc()
+                await finished.put((position, filename, e))
+            except Exception as e:
+                metrics.ERRORS.labels("batch", "500").inc()
+                await finished.put((position, filename, HTTPException(status_code=500, detail=str(e))))
 
-    relative_url = f"view_storage/{datetime.now().strftime('%Y-%m-%d')}/shrunk/{shrunk_filename}"
+    async def run_all():
+        await asyncio.gather(produce(), *(consume() for _ in range(concurrency)))
+        await finished.put(None)
 
+    def as_result(filename, outcome):
+        if isinstance(outcome, HTTPException):
+            return {"filename": filename, "error": outcome.detail, "status_code": outcome.status_code}
+        return {"filename": filename, **outcome}
+
+    runner = asyncio.create_task(run_all())
+    background_tasks.add_task(evict_derived)
+
+    if stream:
+        async def lines():
+            while (entry := await finished.get()) is not None:
+                _, filename, outcome = entry
+                yield json.dumps(as_result(filename, outcome)) + "\n"
+            await runner
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    await runner
+    results = []
+    while (entry := finished.get_nowait()) is not None:
+        results.append(entry)
+    results.sort(key=lambda entry: entry[0])
+    items = [as_result(filename, outcome) for _, filename, outcome in results]
     return {
-        "message": "File processed",
-        "relative_url": relative_url,
-        "width": width,
-        "height": target_height,
-        "savings": f"{os.path.getsize(file_path) / os.path.getsize(shrunk_path):.1f}x smaller",
+        "message": "Batch processed",
+        "processed": sum("error" not in item for item in items),
+        "failed": sum("error" in item for item in items),
+        "results": items,
     }
 
 
-@app.post("/upscale")
-async def upscale_image(file_key: str = Query(...)):
-    original_path = find_original_file(file_key)
-    if not original_path:
+def fit_width(orig_w: int, orig_h: int, w: int | None, h: int | None) -> int:
+    """Width of the largest rendition inside a w x h box (either may be
+    None) that keeps the aspect ratio and never enlarges the original."""
+    width = orig_w
+    if w:
+        width = min(width, w)
+    if h:
+        width = min(width, max(1, round(h * orig_w / orig_h)))
+    return width
+
+
+async def render_rendition(record: dict, original_path: Path, width: int, fmt: str,
+                           target: QualityTarget, cache_key: str):
+    """Renders one rendition of a stored original into the derived cache.
+
+    Returns (path, created); created is False when another request or
+    server process rendered it first.
+    """
+    async with locks.for_key(cache_key):
+        # Another server process may have rendered it while we waited.
+        cached = await run_in_threadpool(find_derived, cache_key)
+        if cached:
+            return STORAGE_ROOT / cached["path"], False
+        path = get_storage_path("shrunk") / shrunk_filename(
+            record["content_hash"], record["rotate"], width, target.spec, fmt
+        )
+        try:
+            result = await shrink_pool.run(shrink_stored, str(original_path), [(width, fmt, str(path))], target)
+        except ImageError as e:
+            metrics.ERRORS.labels("resize", str(e.status_code)).inc()
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        metrics.observe_stages(result["timings"])
+        (rendition,) = result["renditions"]
+        metrics.BYTES_OUT.labels("resize").inc(rendition["size"])
+        await run_in_threadpool(publish, path)
+        await run_in_threadpool(
+            index.put_derived, cache_key, "shrink", record["content_hash"], relative_path(path),
+            rendition["width"], rendition["height"], rendition["size"], rendition["quality"],
+        )
+    return path, True
+
+
+async def load_rendition(record: dict, original_path: Path, width: int, fmt: str,
+                         target: QualityTarget, cache_key: str):
+    """Encoded bytes of one rendition from the disk cache, rendering it on a miss.
+
+    Returns (content, created) where created says whether a new file was
+    written to the derived cache.
+    """
+    with metrics.timed("lookup"):
+        content = await run_in_threadpool(read_derived, cache_key)
+    metrics.CACHE_LOOKUPS.labels("disk", "hit" if content is not None else "miss").inc()
+    if content is not None:
+        return content, False
+    path, created = await render_rendition(record, original_path, width, fmt, target, cache_key)
+    return await run_in_threadpool(path.read_bytes), created
+
+
+@app.get("/img/{file_key}")
+async def resized_image(request: Request, background_tasks: BackgroundTasks, file_key: str,
+                        w: int | None = Query(None, gt=0), h: int | None = Query(None, gt=0),
+                        fmt: str = "webp", q: int = Query(80, ge=1, le=100)):
+    """Serves a stored original resized to fit w x h, encoded as fmt at quality q.
+
+    Renditions are shared with /shrink through the derived cache, with the
+    most recently served ones also kept in memory. Concurrent requests for
+    the same rendition wait for a single render.
+    """
+    check_formats([fmt])
+    with metrics.timed("lookup"):
+        record = await run_in_threadpool(find_record, file_key)
+        original_path = await run_in_threadpool(find_original_file, file_key)
+    if not record or not original_path:
         raise HTTPException(status_code=404, detail="Original file not found")
 
-    # Read the (already rotated) original image
-    orig_img = cv2.imread(str(original_path))
-    if orig_img is None:
-        raise HTTPException(status_code=400, detail="Could not read original image")
-    orig_h, orig_w = orig_img.shape[:2]
-
-    # Locate the Shrunk version for comparison
-    shrunk_filename = f"{Path(file_key).stem}.webp"
-    shrunk_matches = list(STORAGE_ROOT.glob(f"**/shrunk/{shrunk_filename}"))
-    shrunk_url = None
-    shrunk_res = "N/A"
-    
-    if shrunk_matches:
-        date_folder = shrunk_matches[0].parent.parent.name
-        shrunk_url = f"view_storage/{date_folder}/shrunk/{shrunk_filename}"
-        s_img = cv2.imread(str(shrunk_matches[0]))
-        if s_img is not None:
-            shrunk_res = f"{s_img.shape[1]}x{s_img.shape[0]}"
-
-    upscaled_dir = get_storage_path("upscaled")
-    upscaled_filename = f"upscaled_{file_key}"
-    output_path = upscaled_dir / upscaled_filename
-    date_now = datetime.now().strftime("%Y-%m-%d")
+    orig_w, orig_h = record["original_width"], record["original_height"]
+    if orig_w and orig_h:
+        width = fit_width(orig_w, orig_h, w, h)
+    elif w:
+        # Older index rows may lack dimensions; the pipeline still keeps the aspect ratio.
+        width = w
+    else:
+        raise HTTPException(status_code=400, detail="Original dimensions unknown, pass w")
 
-    try:
-        if os.path.exists("inference_realesrgan.py"):
-            subprocess.run(
-                [
-                    "python", "inference_realesrgan.py",
-                    "-n", "RealESRGAN_x4plus",
-                    "-i", str(original_path),
-                    "-o", str(output_path),
-                ],
-                check=True,
-            )
+    target = QualityTarget(q)
+    cache_key = shrink_cache_key(record["content_hash"], record["rotate"], width, target.spec_for(fmt), fmt)
+    # The name of the rendition identifies its bytes, like the immutable storage URLs.
+    etag = f'"{shrunk_filename(record["content_hash"], record["rotate"], width, target.spec_for(fmt), fmt)}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={config.IMG_MAX_AGE}"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
 
-            enhanced_img = cv2.imread(str(output_path))
-            if enhanced_img.shape[1] != orig_w or enhanced_img.shape[0] != orig_h:
-                final_img = cv2.resize(
-                    enhanced_img, (orig_w, orig_h), interpolation=cv2.INTER_LANCZOS4
-                )
-                cv2.imwrite(str(output_path), final_img)
-        else:
-            # High-quality fallback
-            upscaled_img = cv2.resize(orig_img, (orig_w, orig_h), interpolation=cv2.INTER_CUBIC)
-            cv2.imwrite(str(output_path), upscaled_img)
+    content = rendition_cache.get(cache_key)
+    metrics.CACHE_LOOKUPS.labels("memory", "hit" if content is not None else "miss").inc()
+    if content is None:
+        (content, created), shared = await rendition_flights.run(
+            cache_key, partial(load_rendition, record, original_path, width, fmt, target, cache_key)
+        )
+        if not shared:
+            rendition_cache.put(cache_key, content)
+            if created:
+                background_tasks.add_task(evict_derived)
+    return Response(content, media_type=f"image/{fmt}", headers=headers)
+
+
+async def run_upscale(file_key: str, original_path: Path, engine_name: str):
+    """Upscales a file's shrunk rendition back to the original's size; runs as a job.
 
-        orig_date = original_path.parent.parent.name
+    A file whose rendition was evicted, predates content-addressed names or
+    is as large as the original gets a new one first: at the recorded width
+    if that was smaller than the original, otherwise at half its width.
+    Without a known original size nothing can be restored, and the original
+    is returned as is.
+    """
+    with metrics.timed("lookup"):
+        record = await run_in_threadpool(index.get, file_key)
+        shrunk_path = await run_in_threadpool(find_shrunk_file, file_key)
+    width, height = record["original_width"], record["original_height"]
+    if not (width and height and width > 1):
         return {
-            "message": "Upscale successful",
-            "original_url": f"view_storage/{orig_date}/originals/{file_key}",
-            "shrunk_url": shrunk_url,
-            "upscaled_url": f"view_storage/{date_now}/upscaled/{upscaled_filename}",
-            "orig_res": f"{orig_w}x{orig_h}",
-            "shrunk_res": shrunk_res,
-            "up_res": f"{orig_w}x{orig_h}",
+            "message": "Nothing to upscale",
+            "original_url": storage_url(relative_path(original_path)),
+            "shrunk_url": None,
+            "upscaled_url": storage_url(relative_path(original_path)),
+            "orig_res": f"{width}x{height}" if width else "N/A",
+            "shrunk_res": "N/A",
+            "up_res": f"{width}x{height}" if width else "N/A",
+            "engine": None,
+            "source": "original",
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Upscaling failed: {str(e)}")
\ No newline at end of file
+
+    shrunk_width = record["shrunk_width"] or width
+    if not (shrunk_path and shrunk_width < width and upscale_source_token(shrunk_path.name)):
+        target = QualityTarget()
+        rendition_width = shrunk_width if shrunk_width < width else width // 2
+        rendition_key = shrink_cache_key(record["content_hash"], record["rotate"], rendition_width, target.spec)
+        shrunk_path, created = await render_rendition(
+            record, original_path, rendition_width, "webp", target, rendition_key
+        )
+        rendition = await run_in_threadpool(find_derived, rendition_key)
+        await run_in_threadpool(
+            index.update, file_key, shrunk_path=relative_path(shrunk_path), shrunk_width=rendition["width"],
+            shrunk_height=rendition["height"], shrunk_size=rendition["size"],
+        )
+        record.update(shrunk_width=rendition["width"], shrunk_height=rendition["height"])
+        if created:
+            await run_in_threadpool(evict_derived)
+    shrunk_url = storage_url(relative_path(shrunk_path))
+    shrunk_res = f"{record['shrunk_width']}x{record['shrunk_height']}"
+    source_path, source = shrunk_path, upscale_source_token(shrunk_path.name)
+
+    # Named after the original's content, the source rendition and the
+    # engine, so the URL is immutable and identical requests share one file.
+    extension = Path(file_key).suffix
+    cache_key = upscale_cache_key(record["content_hash"], record["rotate"], engine_name, extension, source)
+    # The same upscale running in another server process is waited for and reused.
+    async with locks.for_key(cache_key):
+        with metrics.timed("lookup"):
+            cached = await run_in_threadpool(find_derived, cache_key)
+        metrics.CACHE_LOOKUPS.labels("upscale", "hit" if cached else "miss").inc()
+
+        if cached:
+            output_path = STORAGE_ROOT / cached["path"]
+            orig_w, orig_h, upscaled_size = cached["width"], cached["height"], cached["size"]
+        else:
+            output_path = get_storage_path("upscaled") / upscaled_filename(
+                record["content_hash"], record["rotate"], engine_name, extension, source
+            )
+            try:
+                orig_w, orig_h, upscaled_size, engine_name, timings = await upscale_pool.run(
+                    upscale_stored, str(source_path), str(output_path), width, height, engine_name,
+                )
+            except ImageError as e:
+                metrics.ERRORS.labels("upscale", str(e.status_code)).inc()
+                raise HTTPException(status_code=e.status_code, detail=e.detail)
+            except Exception as e:
+                metrics.ERRORS.labels("upscale", "500").inc()
+                raise HTTPException(status_code=500, detail=f"Upscaling failed: {str(e)}")
+
+            metrics.observe_stages(timings)
+            metrics.PIXELS.labels("upscale").inc(orig_w * orig_h)
+            metrics.BYTES_OUT.labels("upscale").inc(upscaled_size)
+            await run_in_threadpool(publish, output_path)
+            # Upscales share the derived cache's LRU eviction, with their own budget.
+            await run_in_threadpool(
+                index.put_derived, cache_key, "upscale", record["content_hash"], relative_path(output_path),
+                orig_w, orig_h, upscaled_size,
+            )
+            await run_in_threadpool(evict_derived)
+
+    await run_in_threadpool(
+        index.update, file_key, upscaled_path=relative_path(output_path), upscaled_size=upscaled_size
+    )
+
+    return {
+        "message": "Upscale successful",
+        "original_url": storage_url(relative_path(original_path)),
+        "shrunk_url": shrunk_url,
+        "upscaled_url": storage_url(relative_path(output_path)),
+        "orig_res": f"{orig_w}x{orig_h}",
+        "shrunk_res": shrunk_res,
+        "up_res": f"{orig_w}x{orig_h}",
+        "engine": engine_name,
+        "source": "shrunk",
+    }
+
+
+@app.post("/upscale")
+async def upscale_image(file_key: str = Query(...), method: str | None = None,
+                        priority: int = 0, wait: bool = False):
+    """Queues an upscale job and returns it immediately with status 202.
+
+    method picks the engine (realesrgan, fsrcnn, espcn or lanczos); by
+    default the configured one is used. Poll GET /jobs/{job_id} for the
+    result. The same file_key and method already queued or running returns
+    that job instead of starting another. wait=true blocks until the job
+    finishes and returns its result directly.
+    """
+    with metrics.timed("lookup"):
+        original_path = await run_in_threadpool(find_original_file, file_key)
+    if not original_path:
+        raise HTTPException(status_code=404, detail="Original file not found")
+    try:
+        engine = await run_in_threadpool(load_engine, method)
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job, _ = upscale_jobs.submit(
+        f"{file_key}:{engine.name}", partial(run_upscale, file_key, original_path, engine.name), priority
+    )
+    if wait:
+        await job.wait()
+        if job.status == FAILED:
+            raise HTTPException(status_code=job.status_code, detail=job.error)
+        return job.result
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = upscale_jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    # Submitted to another server process.
+    state = await run_in_threadpool(index.get_job, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return state
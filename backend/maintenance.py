@@ -0,0 +1,267 @@
+"""Background storage maintenance, so disk usage and index size stay bounded.
+
+Each run, driven entirely by the index rather than by walking the tree:
+
+1. deletes shrunk and upscaled artifacts unused for RETAIN_*_DAYS,
+2. evicts the least recently used ones beyond each kind's size budget,
+3. deletes originals unused for RETAIN_ORIGINALS_DAYS or beyond
+   ORIGINALS_QUOTA_BYTES, together with everything derived from them,
+4. moves originals unused for ARCHIVE_ORIGINALS_DAYS into a zip pack
+   (restored on their next use by storage.find_original_file),
+5. rewrites packs that are mostly dead and deletes empty ones,
+6. removes dated folders left empty by the steps above,
+7. forgets the perceptual hashes of originals that are gone.
+
+The server runs this every MAINTENANCE_INTERVAL seconds; it can also be
+run by hand with `python -m backend.maintenance`. A lock on the storage
+root makes sure only one process runs it at a time.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+import zipfile
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+from . import config
+from .atomic import replacing
+from .index import ARCHIVE_MANIFEST, ORIGINAL_DIR_RE, original_dirname
+from .storage import ARCHIVE_ROOT, STORAGE_ROOT, index, locks, relative_path, store, unpublish
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+# Touched after every run, so server processes sharing the storage root
+# can tell that one of them has just done the work.
+LAST_RUN = STORAGE_ROOT / ".locks" / "maintenance.done"
+
+
+class _Run:
+    """Counts what one maintenance run did and which folders it touched."""
+
+    def __init__(self):
+        self.stats: dict[str, int] = {}
+        self.folders: set[Path] = set()
+
+    def count(self, name: str, n: int = 1):
+        if n:
+            self.stats[name] = self.stats.get(name, 0) + n
+
+    def remove(self, relative_paths) -> int:
+        removed = 0
+        for relative in relative_paths:
+            unpublish(relative)
+            path = STORAGE_ROOT / relative
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                if store.remote:
+                    # Only the object store had it.
+                    removed += 1
+                continue
+            self.count("freed_bytes", size)
+            self.folders.add(path.parent)
+            removed += 1
+        return removed
+
+
+def _expire_derived(run: _Run, now: float):
+    for kind, days in (("shrink", config.RETAIN_SHRUNK_DAYS), ("upscale", config.RETAIN_UPSCALED_DAYS)):
+        if days > 0:
+            run.count(f"expired_{kind}", run.remove(index.pop_stale_derived(kind, now - days * DAY)))
+    for kind, budget in (("shrink", config.DERIVED_CACHE_BYTES), ("upscale", config.UPSCALED_CACHE_BYTES)):
+        run.count(f"evicted_{kind}", run.remove(index.pop_lru_derived(budget, kind)))
+
+
+def _original_groups() -> list[dict]:
+    """Stored originals grouped by content, least recently used first."""
+    last_access = index.derived_last_access()
+    groups: dict[tuple, dict] = {}
+    for row in index.originals():
+        group = groups.setdefault((row["content_hash"], row["rotate"]), {
+            "content_hash": row["content_hash"], "rotate": row["rotate"], "rows": [],
+            "last_used": last_access.get(row["content_hash"], 0.0),
+        })
+        group["rows"].append(row)
+        group["last_used"] = max(group["last_used"], row["updated_at"])
+    for group in groups.values():
+        # Hard links and archive members both hold the bytes once per location.
+        locations = {
+            row["original_archive"] or str(Path(row["original_path"]).parent) for row in group["rows"]
+        }
+        group["size"] = max(row["original_size"] or 0 for row in group["rows"]) * len(locations)
+    return sorted(groups.values(), key=lambda group: group["last_used"])
+
+
+def _delete_originals(run: _Run, groups: list[dict]):
+    for group in groups:
+        rows = group["rows"]
+        deleted = set(index.delete_files([(row["file_key"], row["updated_at"]) for row in rows]))
+        # Re-uploaded meanwhile rows survive, and so must any file they point at.
+        kept = {row["original_path"] for row in rows if row["file_key"] not in deleted}
+        run.remove(
+            row["original_path"] for row in rows
+            if row["file_key"] in deleted and not row["original_archive"] and row["original_path"] not in kept
+        )
+        run.count("deleted_originals", len(deleted))
+        if deleted and not index.find_by_hash(group["content_hash"]):
+            run.count("deleted_derived", run.remove(index.pop_derived_for(group["content_hash"])))
+
+
+def _expire_originals(run: _Run, groups: list[dict], now: float) -> list[dict]:
+    """Deletes originals past their retention or quota; returns the groups that remain."""
+    doomed = []
+    if config.RETAIN_ORIGINALS_DAYS > 0:
+        cutoff = now - config.RETAIN_ORIGINALS_DAYS * DAY
+        doomed = [group for group in groups if group["last_used"] < cutoff]
+        groups = [group for group in groups if group["last_used"] >= cutoff]
+    if config.ORIGINALS_QUOTA_BYTES > 0:
+        total = sum(group["size"] for group in groups)
+        while groups and total > config.ORIGINALS_QUOTA_BYTES:
+            group = groups.pop(0)
+            total -= group["size"]
+            doomed.append(group)
+    _delete_originals(run, doomed)
+    return groups
+
+
+def _write_pack(members: dict, manifest: dict[str, list[str]]) -> Path:
+    """Writes a new pack atomically; members maps member names to callables returning their bytes."""
+    ARCHIVE_ROOT.mkdir(exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    pack = ARCHIVE_ROOT / f"originals-{stamp}-{uuid.uuid4().hex[:8]}.zip"
+    with replacing(pack) as tmp:
+        # Images are already compressed, so members are stored as they are.
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as zf:
+            for member, read in members.items():
+                zf.writestr(member, read())
+            zf.writestr(ARCHIVE_MANIFEST, json.dumps(manifest))
+        # The originals are deleted once the pack exists, so it must be on disk first.
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+    return pack
+
+
+def _archive_originals(run: _Run, groups: list[dict], now: float):
+    # Object stores have their own storage classes for this (lifecycle rules).
+    if config.ARCHIVE_ORIGINALS_DAYS <= 0 or store.remote:
+        return
+    cutoff = now - config.ARCHIVE_ORIGINALS_DAYS * DAY
+    members, manifest, chosen, total = {}, {}, [], 0
+    for group in groups:
+        if group["last_used"] >= cutoff or total >= config.ARCHIVE_PACK_BYTES:
+            break
+        rows = group["rows"]
+        if any(row["original_archive"] for row in rows):
+            continue
+        source = STORAGE_ROOT / rows[0]["original_path"]
+        # Flat legacy originals have no content folder to restore into.
+        if not ORIGINAL_DIR_RE.match(source.parent.name) or not source.exists():
+            continue
+        member = f"{original_dirname(group['content_hash'], group['rotate'])}/{source.name}"
+        members[member] = source.read_bytes
+        manifest[member] = [row["file_key"] for row in rows]
+        chosen.append((group, member))
+        total += group["size"]
+    if not members:
+        return
+
+    pack = _write_pack(members, manifest)
+    archive = relative_path(pack)
+    archived = 0
+    for group, member in chosen:
+        rows = group["rows"]
+        moved = {
+            row["file_key"] for row in rows
+            if index.mark_archived(row["file_key"], row["original_path"], row["updated_at"], archive, member)
+        }
+        kept = {row["original_path"] for row in rows if row["file_key"] not in moved}
+        run.remove(
+            row["original_path"] for row in rows
+            if row["file_key"] in moved and row["original_path"] not in kept
+        )
+        archived += len(moved)
+    run.count("archived_originals", archived)
+    if not archived:
+        pack.unlink(missing_ok=True)
+
+
+def _compact_archives(run: _Run):
+    for pack in sorted(ARCHIVE_ROOT.glob("originals-*.zip")):
+        archive = relative_path(pack)
+        referenced = index.archive_members(archive)
+        if not referenced:
+            run.count("freed_bytes", pack.stat().st_size)
+            pack.unlink(missing_ok=True)
+            run.count("removed_packs")
+            continue
+        with zipfile.ZipFile(pack) as zf:
+            infos = [info for info in zf.infolist() if info.filename != ARCHIVE_MANIFEST]
+            total = sum(info.file_size for info in infos) or 1
+            live = sum(info.file_size for info in infos if info.filename in referenced)
+            if live * 100 >= total * config.ARCHIVE_COMPACT_PERCENT:
+                continue
+            manifest = json.loads(zf.read(ARCHIVE_MANIFEST))
+            new_pack = _write_pack(
+                {member: partial(zf.read, member) for member in sorted(referenced)},
+                {member: manifest.get(member, []) for member in sorted(referenced)},
+            )
+        index.move_archive(archive, relative_path(new_pack))
+        run.count("freed_bytes", pack.stat().st_size - new_pack.stat().st_size)
+        pack.unlink()
+        run.count("compacted_packs")
+
+
+def _prune_folders(folders: set[Path]):
+    today = STORAGE_ROOT / datetime.now().strftime("%Y-%m-%d")
+    for folder in sorted(folders, key=lambda path: len(path.parts), reverse=True):
+        # Today's folders may be written to at any moment, so they are left alone.
+        while folder != STORAGE_ROOT and folder != today and STORAGE_ROOT in folder.parents:
+            try:
+                folder.rmdir()
+            except OSError:
+                # Not empty, or already gone.
+                break
+            folder = folder.parent
+
+
+def run_maintenance(min_interval: float = 0) -> dict[str, int]:
+    """Runs every maintenance step once; returns counts of what was done.
+
+    Skips the run if another process is running it, or finished less than
+    min_interval seconds ago.
+    """
+    lock = locks.named("maintenance")
+    if not lock.acquire(blocking=False):
+        logger.info("Storage maintenance already running, skipping")
+        return {}
+    try:
+        now = time.time()
+        if min_interval and LAST_RUN.exists() and now - LAST_RUN.stat().st_mtime < min_interval:
+            return {}
+        started = time.monotonic()
+        run = _Run()
+        run.count("purged_jobs", index.purge_jobs(now - config.JOB_TTL))
+        _expire_derived(run, now)
+        groups = _expire_originals(run, _original_groups(), now)
+        _archive_originals(run, groups, now)
+        if ARCHIVE_ROOT.exists():
+            _compact_archives(run)
+        _prune_folders(run.folders)
+        run.count("purged_phashes", index.purge_phashes())
+        LAST_RUN.touch()
+        logger.info("Storage maintenance finished in %.1fs: %s",
+                    time.monotonic() - started, run.stats or "nothing to do")
+        return run.stats
+    finally:
+        lock.release()
+
+
+if __name__ == "__main__":
+    # python -m backend.maintenance  -> one maintenance run
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(run_maintenance(), indent=2))
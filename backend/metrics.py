@@ -0,0 +1,126 @@
+"""Prometheus metrics and per-request stage timings.
+
+Pipeline functions may run in worker processes, so they never touch the
+registry: they time their stages with a StageTimer and return the totals,
+which the server process then records with observe_stages(). Every stage
+recorded while a request is being handled is also collected for that
+request's Server-Timing header.
+
+With several server processes, PROMETHEUS_MULTIPROC_DIR is set (see
+backend.serve) and every process writes its values there, so /metrics on
+any of them reports the totals of all.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# From a cache lookup (milliseconds) up to a large tiled upscale (minutes).
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to produce a response, by route",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter("http_requests", "Responses sent, by route and status", ["method", "route", "status"])
+STAGE_SECONDS = Histogram(
+    "image_stage_duration_seconds", "Time spent in each image pipeline stage",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+BYTES_IN = Counter("image_bytes_in", "Bytes of uploaded images read")
+BYTES_OUT = Counter("image_bytes_out", "Bytes of encoded images written", ["kind"])
+PIXELS = Counter("image_pixels", "Full-resolution pixels of the images processed", ["kind"])
+CACHE_LOOKUPS = Counter("derived_cache_lookups", "Derived image cache lookups, by cache tier", ["cache", "result"])
+NEAR_DUPLICATES = Counter(
+    "near_duplicate_uploads", "New uploads resembling a stored original, by what was done", ["action"]
+)
+ERRORS = Counter("image_errors", "Failed image operations, by kind and status code", ["kind", "status"])
+# Summed over the live server processes in multi-process mode.
+POOL_DEPTH = Gauge("worker_pool_depth", "Jobs running or waiting in a worker pool", ["pool"],
+                   multiprocess_mode="livesum")
+JOB_QUEUE_DEPTH = Gauge("job_queue_depth", "Jobs queued or running in a job queue", ["queue"],
+                        multiprocess_mode="livesum")
+JOBS = Counter("jobs_finished", "Finished jobs, by queue and status", ["queue", "status"])
+
+_request_stages: ContextVar[dict | None] = ContextVar("request_stages", default=None)
+
+
+class StageTimer:
+    """Adds up wall time per stage; safe to share with helper threads."""
+
+    def __init__(self):
+        self.totals: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.totals[name] = self.totals.get(name, 0.0) + elapsed
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def observe_stages(totals: dict[str, float]):
+    """Records the stage totals returned by a pipeline function."""
+    for name, seconds in totals.items():
+        observe_stage(name, seconds)
+
+
+@contextmanager
+def timed(name: str):
+    """Times a stage that runs in the server process, e.g. an index lookup."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def begin_request():
+    """Starts collecting stages for the current request; returns a token for end_request."""
+    return _request_stages.set({})
+
+
+def end_request(token) -> dict[str, float]:
+    stages = _request_stages.get() or {}
+    _request_stages.reset(token)
+    return stages
+
+
+def server_timing(stages: dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items())
+
+
+def multiprocess_mode() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def exposition() -> bytes:
+    """Every metric in the Prometheus text format, across all server processes."""
+    if not multiprocess_mode():
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def process_exiting():
+    """Drops this process's live gauges from the shared totals."""
+    if multiprocess_mode():
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,161 @@
+"""Where stored files are kept besides STORAGE_ROOT, and the URLs clients fetch them from.
+
+Every file is first written under STORAGE_ROOT, and its path relative to
+the root doubles as its object key. LocalStore leaves it there to be served
+by /view_storage. S3Store also uploads it to an S3-compatible bucket (AWS,
+MinIO, ...) and downloads keys that are missing locally, so STORAGE_ROOT
+becomes a cache and several nodes can share one bucket; clients get
+presigned or public bucket URLs, so the bytes never pass through Python.
+"""
+import logging
+import mimetypes
+from pathlib import Path
+
+from . import config
+from .atomic import replacing
+
+logger = logging.getLogger(__name__)
+
+
+class StoreUnavailable(Exception):
+    """The configured storage backend cannot be used."""
+
+
+class ObjectStore:
+    name = "base"
+    # Whether files may exist in the store but not under STORAGE_ROOT.
+    remote = False
+
+    def put_file(self, key: str, path: Path, cache_control: str | None = None):
+        """Makes the local file at path available under key."""
+
+    def fetch(self, key: str, path: Path) -> bool:
+        """Downloads key to path; returns False if the store does not have it."""
+        return False
+
+    def copy(self, source_key: str, key: str):
+        """Stores the object at source_key under key as well."""
+
+    def delete(self, key: str):
+        pass
+
+    def put_bytes(self, key: str, data: bytes, content_type: str = "application/octet-stream"):
+        pass
+
+    def get_bytes(self, key: str) -> bytes | None:
+        return None
+
+    def url(self, key: str) -> str:
+        """Where clients can download key; relative URLs are relative to the backend."""
+        return f"view_storage/{key}"
+
+
+class LocalStore(ObjectStore):
+    """Files stay under STORAGE_ROOT and are served by the app itself."""
+
+    name = "local"
+
+
+class S3Store(ObjectStore):
+    """An S3-compatible bucket, with STORAGE_ROOT as a local cache in front of it."""
+
+    name = "s3"
+    remote = True
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str | None = None,
+                 region: str | None = None, public_url: str | None = None,
+                 presign_seconds: int = 3600, max_connections: int = 32,
+                 multipart_bytes: int = 16 * 1024**2, upload_threads: int = 4):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise StoreUnavailable("STORAGE_BACKEND=s3 needs boto3 (pip install boto3)") from e
+        if not bucket:
+            raise StoreUnavailable("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.presign_seconds = presign_seconds
+        self._client_error = ClientError
+        # botocore clients are thread-safe; one shared client keeps one pool
+        # of connections for every worker thread.
+        self.client = boto3.session.Session().client(
+            "s3", endpoint_url=endpoint_url or None, region_name=region or None,
+            config=Config(
+                max_pool_connections=max_connections, retries={"mode": "standard"},
+                signature_version="s3v4",
+            ),
+        )
+        # Large files are streamed from disk in parts, several at a time.
+        self.transfer = TransferConfig(
+            multipart_threshold=multipart_bytes, multipart_chunksize=multipart_bytes,
+            max_concurrency=upload_threads,
+        )
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def _missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put_file(self, key: str, path: Path, cache_control: str | None = None):
+        extra = {"ContentType": mimetypes.guess_type(path.name)[0] or "application/octet-stream"}
+        if cache_control:
+            extra["CacheControl"] = cache_control
+        self.client.upload_file(str(path), self.bucket, self._key(key), ExtraArgs=extra, Config=self.transfer)
+
+    def fetch(self, key: str, path: Path) -> bool:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with replacing(path) as tmp:
+                self.client.download_file(self.bucket, self._key(key), str(tmp), Config=self.transfer)
+        except self._client_error as e:
+            if self._missing(e):
+                return False
+            raise
+        return True
+
+    def copy(self, source_key: str, key: str):
+        # Copied inside the store, in parts for large objects; no bytes pass through here.
+        source = {"Bucket": self.bucket, "Key": self._key(source_key)}
+        self.client.copy(source, self.bucket, self._key(key), Config=self.transfer)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def put_bytes(self, key: str, data: bytes, content_type: str = "application/octet-stream"):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, ContentType=content_type)
+
+    def get_bytes(self, key: str) -> bytes | None:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+        except self._client_error as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def url(self, key: str) -> str:
+        if self.public_url:
+            return f"{self.public_url}/{self._key(key)}"
+        # Signed locally; no request is made to the store.
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._key(key)},
+            ExpiresIn=self.presign_seconds,
+        )
+
+
+def create_store() -> ObjectStore:
+    if config.STORAGE_BACKEND == "local":
+        return LocalStore()
+    if config.STORAGE_BACKEND == "s3":
+        store = S3Store(
+            config.S3_BUCKET, config.S3_PREFIX, config.S3_ENDPOINT_URL, config.S3_REGION,
+            config.S3_PUBLIC_URL, config.S3_PRESIGN_SECONDS, config.S3_MAX_CONNECTIONS,
+            config.S3_MULTIPART_BYTES, config.S3_UPLOAD_THREADS,
+        )
+        logger.info("Storing files in s3://%s/%s", store.bucket, store.prefix)
+        return store
+    raise StoreUnavailable(f"Unknown STORAGE_BACKEND {config.STORAGE_BACKEND!r}, expected 'local' or 's3'")
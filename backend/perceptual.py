@@ -0,0 +1,64 @@
+"""Perceptual hashes for spotting near-duplicate uploads.
+
+A content hash only matches byte-identical uploads. The same photo re-saved
+at another quality, resized or converted to another format has different
+bytes but almost the same difference hash (dHash): one bit per pair of
+neighbouring pixels of a 9x8 grayscale thumbnail, saying whether brightness
+rises from left to right. Two images are near-duplicates when their hashes
+differ in only a few of the 64 bits.
+
+To find those without comparing against every stored hash, each hash is cut
+into BANDS bands of 8 bits that the index keeps in an indexed table
+(multi-index hashing). Hashes within BANDS - 1 bits of each other share at
+least one band exactly, so looking up the query's bands yields every such
+candidate, and only those candidates are compared in full.
+"""
+import cv2
+import numpy as np
+
+HASH_BITS = 64
+BANDS = 8
+BAND_BITS = HASH_BITS // BANDS
+# The largest distance the band lookup is guaranteed to find.
+MAX_DISTANCE = BANDS - 1
+
+
+def dhash(img) -> int:
+    """The 64-bit difference hash of a decoded image (BGR or grayscale)."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash_encoded(source) -> int | None:
+    """Hashes encoded image bytes or a file path, or returns None if it does not decode.
+
+    A thumbnail of 9x8 pixels needs very little of the image, so it is
+    decoded in grayscale at a quarter of its size.
+    """
+    if isinstance(source, str):
+        img = cv2.imread(source, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    else:
+        img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    return dhash(img) if img is not None else None
+
+
+def distance(a: int, b: int) -> int:
+    """Number of bits in which two hashes differ."""
+    return (a ^ b).bit_count()
+
+
+def bands(value: int) -> list[int]:
+    """The BANDS pieces of a hash, lowest bits first."""
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+
+def to_signed(value: int) -> int:
+    """A 64-bit hash as the signed integer SQLite can store."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def from_signed(value: int) -> int:
+    return value & ((1 << HASH_BITS) - 1)
@@ -0,0 +1,272 @@
+"""Blocking image pipeline steps.
+
+Everything in here is plain synchronous code that is safe to run on a worker
+pool (thread or process). Functions take and return picklable values only.
+"""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import codecs, config
+from .atomic import replacing, write_atomic
+from .codecs import CodecError, QualityTarget
+from .index import ORIENTATION_TAG, TRANSPOSED_ORIENTATIONS
+from .metrics import StageTimer
+from .perceptual import dhash
+from .tiling import disk_backed_array, should_tile, tiled_upscale
+from .upscaler import get_engine
+
+# Small pool for file writes that overlap with CPU work inside a job.
+_io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="io-writer")
+
+# OpenCV would otherwise start a thread per core in every server and pool
+# process; each process gets its share of the cores instead.
+cv2.setNumThreads(config.OPENCV_THREADS)
+
+
+class ImageError(Exception):
+    """An image could not be decoded or encoded; maps to an HTTP error."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+    def __reduce__(self):
+        # Raised inside process pool workers, so it must survive pickling.
+        return type(self), (self.status_code, self.detail)
+
+
+def apply_rotation(img, angle: int):
+    """Rotates the image by 90, 180, or 270 degrees clockwise."""
+    if angle == 90:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    elif angle == 180:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    elif angle == 270:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+
+def _write_bytes(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, data)
+
+
+def _timed_write(timer: StageTimer, path: str, data):
+    with timer.stage("write"):
+        _write_bytes(path, data)
+
+
+def _render(img, targets, target: QualityTarget, timer: StageTimer, source_size=None):
+    """Writes every (width, fmt, path) target from one decoded image.
+
+    Widths are produced largest first, each downsampled from the previous
+    one with INTER_AREA, so a whole set costs little more than the biggest
+    member. source_size is the (width, height) of the full-resolution image
+    when img was decoded at reduced scale, so output heights do not depend
+    on the decode scale. Results are returned in the order of targets;
+    stage times are added to timer.
+    """
+    orig_w, orig_h = source_size or (img.shape[1], img.shape[0])
+    aspect_ratio = orig_h / orig_w
+    results = {}
+    current = img
+    for width in sorted({t[0] for t in targets}, reverse=True):
+        target_height = int(width * aspect_ratio)
+        # Anything at or above the current size has to come from the original.
+        source = current if width < current.shape[1] else img
+        with timer.stage("resize"):
+            current = cv2.resize(source, (width, target_height), interpolation=cv2.INTER_AREA)
+        for target_width, fmt, path in targets:
+            if target_width == width:
+                try:
+                    with timer.stage("encode"):
+                        encoded, quality = codecs.encode(current, fmt, target)
+                except CodecError as e:
+                    raise ImageError(500, str(e))
+                with timer.stage("write"):
+                    _write_bytes(path, encoded)
+                results[(width, fmt)] = {
+                    "width": width, "height": target_height, "format": fmt,
+                    "quality": quality, "size": len(encoded),
+                }
+    return [results[(width, fmt)] for width, fmt, _ in targets]
+
+
+def decode_image(content, flags: int = cv2.IMREAD_COLOR):
+    """Decodes an encoded image straight from memory (no copy of the buffer)."""
+    return cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flags)
+
+
+# JPEG can be decoded at 1/2, 1/4 or 1/8 scale by skipping DCT coefficients.
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _jpeg_size(source):
+    """(width, height) of a JPEG as OpenCV will decode it, or None if not a JPEG.
+
+    Only the header is parsed. EXIF orientation is applied because OpenCV
+    applies it when decoding.
+    """
+    try:
+        with Image.open(io.BytesIO(source) if not isinstance(source, str) else source) as img:
+            if img.format != "JPEG":
+                return None
+            width, height = img.size
+            if img.getexif().get(ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None
+
+
+def decode_for_width(source, max_width: int):
+    """Decodes bytes or a file path at the smallest scale that still covers max_width.
+
+    Large reductions of JPEGs skip most of the decode work this way; other
+    formats, or targets close to the full width, decode at full size.
+    Returns (img, (full_width, full_height)) or (None, None).
+    """
+    read = cv2.imread if isinstance(source, str) else decode_image
+    size = _jpeg_size(source) if config.REDUCED_DECODE else None
+    if size:
+        for factor, flags in REDUCED_DECODE_FLAGS:
+            if size[0] // factor >= max_width:
+                img = read(source, flags)
+                # Fall through to a full decode if the reduced image came out too small.
+                if img is not None and img.shape[1] >= max_width:
+                    return img, size
+                break
+    img = read(source, cv2.IMREAD_COLOR)
+    return (img, (img.shape[1], img.shape[0])) if img is not None else (None, None)
+
+
+def shrink_upload(content: bytes, file_path: str, targets, rotate: int, target: QualityTarget):
+    """Saves an upload as the original and writes its shrunk renditions.
+
+    targets is a list of (width, fmt, path), all encoded for target. Returns the facts about the
+    original and each rendition that the storage index records, including
+    the perceptual hash of the (rotated) original taken from the same
+    decode, plus the time spent per stage.
+    """
+    timer = StageTimer()
+    # Decode from the upload buffer; nothing touches the disk for a bad upload.
+    # A rotated original is re-encoded from the pixels, so it needs a full
+    # decode; otherwise the stored original is the upload itself and the
+    # renditions can come from a reduced-scale decode.
+    with timer.stage("decode"):
+        if rotate in [90, 180, 270]:
+            img = decode_image(content)
+            source_size = None
+        else:
+            img, source_size = decode_for_width(content, max(t[0] for t in targets))
+    if img is None:
+        raise ImageError(400, "Invalid image file")
+
+    # 1. Apply Rotation if requested
+    if rotate in [90, 180, 270]:
+        with timer.stage("rotate"):
+            img = apply_rotation(img, rotate)
+        # Store the rotated version as the original
+        # This ensures future Upscaling uses the correct orientation
+        with timer.stage("encode"):
+            success, original_bytes = cv2.imencode(os.path.splitext(file_path)[1] or ".png", img)
+        if not success:
+            raise ImageError(500, "OpenCV failed to encode the rotated original.")
+    else:
+        original_bytes = content
+
+    # 2. Persist the original on an I/O thread while the renditions are computed
+    pending_write = _io_pool.submit(_timed_write, timer, file_path, original_bytes)
+    try:
+        with timer.stage("hash"):
+            phash = dhash(img)
+        renditions = _render(img, targets, target, timer, source_size)
+    finally:
+        pending_write.result()
+
+    orig_w, orig_h = source_size or (img.shape[1], img.shape[0])
+    return {
+        "original_width": orig_w,
+        "original_height": orig_h,
+        "original_size": len(original_bytes),
+        "phash": phash,
+        "renditions": renditions,
+        "timings": timer.totals,
+    }
+
+
+def hash_upload(content: bytes, rotate: int):
+    """The perceptual hash and full (width, height) an upload will have once rotated.
+
+    Used to look for a near-duplicate before deciding to process the upload
+    at all, so JPEGs are decoded in grayscale at 1/8 scale, which is plenty
+    for the hash. Returns (None, None) if the upload does not decode.
+    """
+    size = _jpeg_size(content) if config.REDUCED_DECODE else None
+    img = decode_image(content, cv2.IMREAD_REDUCED_GRAYSCALE_8 if size else cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None, None
+    width, height = size or (img.shape[1], img.shape[0])
+    if rotate in (90, 270):
+        width, height = height, width
+    return dhash(apply_rotation(img, rotate)), (width, height)
+
+
+def shrink_stored(original_path: str, targets, target: QualityTarget):
+    """Writes new renditions from an original that is already stored (and rotated)."""
+    timer = StageTimer()
+    with timer.stage("decode"):
+        img, source_size = decode_for_width(original_path, max(t[0] for t in targets))
+    if img is None:
+        raise ImageError(400, "Could not read original image")
+    renditions = _render(img, targets, target, timer, source_size)
+    return {"renditions": renditions, "timings": timer.totals}
+
+
+def upscale_stored(source_path: str, output_path: str, width: int | None = None,
+                   height: int | None = None, method: str | None = None):
+    """Upscales a stored image (normally a shrunk rendition) to width x height.
+
+    Without a size the source is enhanced at its own resolution. method
+    picks the engine, None meaning the configured default. Returns
+    (width, height, upscaled_size, engine_name, stage timings).
+    """
+    timer = StageTimer()
+    # Renditions and originals are stored already rotated.
+    with timer.stage("decode"):
+        img = cv2.imread(source_path)
+    if img is None:
+        raise ImageError(400, "Could not read the image to upscale")
+    out_w, out_h = width or img.shape[1], height or img.shape[0]
+
+    engine = get_engine(method)
+    # Concurrent upscales of the same image may race on output_path; each
+    # writes its own temporary file and the last rename wins.
+    with replacing(output_path) as tmp_path:
+        if should_tile(out_w, out_h):
+            # Tiles are blended into a disk-backed array so the full-size result
+            # never has to sit in anonymous memory alongside the float buffers.
+            with disk_backed_array((out_h, out_w, img.shape[2]), os.path.dirname(output_path)) as out:
+                with timer.stage("upscale"):
+                    tiled_upscale(img, engine.upscale, out_w, out_h, out=out)
+                with timer.stage("encode"):
+                    success = cv2.imwrite(str(tmp_path), out)
+        else:
+            with timer.stage("upscale"):
+                upscaled = engine.upscale(img, out_w, out_h)
+            with timer.stage("encode"):
+                success = cv2.imwrite(str(tmp_path), upscaled)
+        if not success:
+            raise ImageError(500, "OpenCV failed to write the upscaled image.")
+
+    return out_w, out_h, os.path.getsize(output_path), engine.name, timer.totals
@@ -0,0 +1,43 @@
+"""Runs the backend with one or more server processes.
+
+    python -m backend.serve [--host 0.0.0.0] [--port 8000] [--workers N]
+
+The processes share the port, the storage volume, the index and its locks;
+workers defaults to WEB_WORKERS (0 meaning one per core). With more than
+one, Prometheus metrics are aggregated through PROMETHEUS_MULTIPROC_DIR,
+which is emptied on every start.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+from . import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=config.SERVER_PROCESSES,
+                        help="server processes, 0 for one per core")
+    args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else config.CPU_COUNT
+
+    # The processes size their pools and OpenCV threads from this.
+    os.environ["WEB_WORKERS"] = str(workers)
+    if workers > 1:
+        # Must be set before any process imports prometheus_client.
+        metrics_dir = os.environ.setdefault(
+            "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "downscale-upscale-metrics")
+        )
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+
+    uvicorn.run("backend.main:app", host=args.host, port=args.port, workers=workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+import json
+import mimetypes
+import os
+import re
+import zipfile
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+
+import anyio
+from fastapi import HTTPException
+from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, PlainTextResponse, Response
+
+from . import config
+from .atomic import LockFolder, write_atomic
+from .index import ARCHIVE_DIR, COLUMNS, ORIGINAL_DIR_RE, SHRUNK_NAME_RE, UPSCALED_NAME_RE, StorageIndex
+from .objectstore import create_store
+
+# --- 1. Storage Configuration ---
+if os.environ.get("STORAGE_ROOT"):
+    STORAGE_ROOT = Path(os.environ["STORAGE_ROOT"])
+elif os.path.exists("/.dockerenv"):
+    STORAGE_ROOT = Path("/app/storage")
+else:
+    STORAGE_ROOT = Path(__file__).parent.parent / "storage"
+
+STORAGE_ROOT.mkdir(parents=True, exist_ok=True)
+
+# Lives inside the storage volume so it persists with the files it describes.
+# Hidden names are never served by StorageFiles below.
+index = StorageIndex(STORAGE_ROOT / ".index.sqlite3")
+# Packs of archived originals; hidden, so only reachable through a restore.
+ARCHIVE_ROOT = STORAGE_ROOT / ARCHIVE_DIR
+# Locks shared by every server process using this storage root.
+locks = LockFolder(STORAGE_ROOT / ".locks")
+# Every file under STORAGE_ROOT is also published here (a no-op for "local").
+store = create_store()
+# With a remote store, each file key's index row is also kept in the store
+# so that other nodes can find files they did not receive themselves.
+KEY_RECORDS = ".keys"
+# Index columns that only describe this node's local state.
+LOCAL_COLUMNS = {"original_archive", "upscaled_path", "upscaled_size"}
+
+
+# Content-addressed files never change under their URL, so browsers may keep
+# them for a year without asking again; anything else is revalidated.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+SINGLE_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def content_etag(path: Path) -> str | None:
+    """A strong ETag for a content-addressed file, or None for any other path.
+
+    Originals live in a folder named after their hash, and shrunk and
+    upscaled files are named after the hash of their source plus everything
+    else that determines their bytes, so the name alone identifies the content.
+    """
+    folder = path.parent
+    if folder.parent.name == "originals" and ORIGINAL_DIR_RE.match(folder.name):
+        return f'"{folder.name}"'
+    if folder.name == "shrunk" and SHRUNK_NAME_RE.match(path.name):
+        return f'"{path.name}"'
+    if folder.name == "upscaled" and UPSCALED_NAME_RE.match(path.name):
+        return f'"{path.name}"'
+    return None
+
+
+def parse_range(header: str, size: int):
+    """(start, end) inclusive for a single "bytes=" range, or None to send the whole file.
+
+    Multiple ranges are answered with the whole file, which RFC 9110 allows.
+    Raises ValueError if the range cannot be satisfied.
+    """
+    match = SINGLE_RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # "bytes=-N" is the last N bytes.
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        raise ValueError(f"Range {header!r} not satisfiable for {size} bytes")
+    return start, end
+
+
+class FileRangeResponse(Response):
+    """206 Partial Content with one byte range of a file, streamed in chunks."""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, start: int, end: int, headers: dict):
+        self.path = path
+        self.start = start
+        self.end = end
+        super().__init__(status_code=206, headers=headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        remaining = self.end - self.start + 1
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # The file shrank underneath us; end the body rather than hang.
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class StorageFiles(StaticFiles):
+    """StaticFiles with long-lived caching and byte ranges; never serves hidden files such as the index."""
+
+    async def get_response(self, path: str, scope):
+        if any(part.startswith(".") for part in Path(path).parts):
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        etag = content_etag(Path(full_path))
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if etag else REVALIDATE_CACHE_CONTROL}
+        if etag:
+            headers["ETag"] = etag
+        # FileResponse only fills in ETag/Last-Modified/Content-Length that are not set yet.
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        request_headers = Headers(scope=scope)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if status_code != 200 or range_header is None:
+            return response
+        if if_range is not None and if_range not in (response.headers["etag"], response.headers["last-modified"]):
+            # The client's partial copy is stale, so it gets the whole file.
+            return response
+        size = stat_result.st_size
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return PlainTextResponse("Range Not Satisfiable", status_code=416,
+                                     headers={"Content-Range": f"bytes */{size}"})
+        if byte_range is None:
+            return response
+        start, end = byte_range
+        headers = dict(response.headers)
+        headers["content-length"] = str(end - start + 1)
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+        return FileRangeResponse(full_path, start, end, headers)
+
+
+def rebuild_index_if_empty():
+    """Rebuilds a missing or fresh index; with several processes starting, only the first does."""
+    with locks.named("index-rebuild"):
+        if index.is_empty():
+            index.rebuild(STORAGE_ROOT)
+
+
+def get_storage_path(subfolder: str):
+    today = datetime.now().strftime("%Y-%m-%d")
+    path = STORAGE_ROOT / today / subfolder
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def relative_path(path: Path) -> str:
+    """The index/URL form of a path under STORAGE_ROOT."""
+    return path.relative_to(STORAGE_ROOT).as_posix()
+
+
+def storage_url(relative: str) -> str:
+    return store.url(relative)
+
+
+def publish(*paths: Path):
+    """Uploads freshly written files to the object store."""
+    for path in paths:
+        store.put_file(relative_path(path), path, IMMUTABLE_CACHE_CONTROL if content_etag(path) else None)
+
+
+def unpublish(relative: str):
+    """Removes a deleted file from the object store as well."""
+    store.delete(relative)
+
+
+def _resolve(relative: str | None):
+    if not relative:
+        return None
+    path = STORAGE_ROOT / relative
+    if path.exists():
+        return path
+    # Another node wrote it, or the local copy was removed.
+    if store.remote and store.fetch(relative, path):
+        return path
+    return None
+
+
+def record_file(file_key: str, **fields):
+    """Updates the index row for file_key and, with a remote store, its shared copy.
+
+    A key uploaded again with other content (cameras reuse names such as
+    IMG_0001.jpg) lets go of its previous original, which is deleted once no
+    key uses it, together with anything derived from content no key has.
+    """
+    previous = index.get(file_key)
+    replaced = previous and "content_hash" in fields and (
+        (fields["content_hash"], fields.get("rotate", 0)) != (previous["content_hash"], previous["rotate"])
+    )
+    if replaced:
+        # The old upscale shows the old content.
+        fields.setdefault("upscaled_path", None)
+        fields.setdefault("upscaled_size", None)
+    index.update(file_key, **fields)
+    if previous and previous["original_path"] != fields.get("original_path", previous["original_path"]):
+        _release_original(previous)
+    if store.remote:
+        row = index.get(file_key)
+        shared = {name: row[name] for name in COLUMNS if name not in LOCAL_COLUMNS and row[name] is not None}
+        store.put_bytes(f"{KEY_RECORDS}/{file_key}.json", json.dumps(shared).encode(), "application/json")
+
+
+def _release_original(previous: dict):
+    """Deletes what only previous, a key's replaced index row, still used."""
+    path = previous["original_path"]
+    # Archived originals stay in their pack until compaction drops them.
+    if path and not previous["original_archive"] and not index.uses_original(path):
+        (STORAGE_ROOT / path).unlink(missing_ok=True)
+        unpublish(path)
+    if previous["content_hash"] and not index.find_by_hash(previous["content_hash"]):
+        for relative in index.pop_derived_for(previous["content_hash"]):
+            (STORAGE_ROOT / relative).unlink(missing_ok=True)
+            unpublish(relative)
+
+
+def find_record(file_key: str) -> dict | None:
+    """The index row for file_key, looking for one recorded by another node if there is none."""
+    record = index.get(file_key)
+    if record is None and store.remote:
+        shared = store.get_bytes(f"{KEY_RECORDS}/{file_key}.json")
+        if shared is not None:
+            index.update(file_key, **json.loads(shared))
+            record = index.get(file_key)
+    return record
+
+
+def restore_original(file_key: str, record: dict):
+    """Extracts an archived original back into today's originals folder.
+
+    Returns the restored path, or None if the archive no longer holds it.
+    """
+    member = PurePosixPath(record["original_path"])
+    folder = get_storage_path("originals") / member.parent.name
+    folder.mkdir(exist_ok=True)
+    extracted = folder / member.name
+    if not extracted.exists():
+        try:
+            with zipfile.ZipFile(STORAGE_ROOT / record["original_archive"]) as zf:
+                data = zf.read(str(member))
+        except (FileNotFoundError, KeyError, zipfile.BadZipFile):
+            return None
+        write_atomic(extracted, data)
+    target = folder / file_key
+    if not target.exists():
+        try:
+            os.link(extracted, target)
+        except FileExistsError:
+            # Restored by a concurrent request.
+            pass
+        except OSError:
+            target = extracted
+    index.update(file_key, original_path=relative_path(target), original_archive=None)
+    return target
+
+
+def find_original_file(filename: str):
+    record = find_record(filename)
+    if record and record["original_archive"]:
+        restored = restore_original(filename, record)
+        if restored is not None:
+            return restored
+        # The pack may have been compacted into a new one meanwhile.
+        record = index.get(filename)
+        if record and record["original_archive"]:
+            return restore_original(filename, record)
+    return _resolve(record["original_path"]) if record else None
+
+
+def find_shrunk_file(filename: str):
+    record = find_record(filename)
+    return _resolve(record["shrunk_path"]) if record else None
+
+
+def find_derived(cache_key: str):
+    """Returns the cached artifact for cache_key if it is still on disk."""
+    record = index.get_derived(cache_key)
+    if record and _resolve(record["path"]) is None:
+        index.delete_derived(cache_key)
+        return None
+    return record
+
+
+def read_derived(cache_key: str) -> bytes | None:
+    """Returns the bytes of a cached artifact, or None if it is not (or no longer) on disk."""
+    record = find_derived(cache_key)
+    if record is None:
+        return None
+    try:
+        return (STORAGE_ROOT / record["path"]).read_bytes()
+    except FileNotFoundError:
+        # Evicted between the lookup and the read.
+        index.delete_derived(cache_key)
+        return None
+
+
+def evict_derived():
+    """Deletes least recently used derived artifacts beyond each kind's size budget."""
+    for kind, budget in (("shrink", config.DERIVED_CACHE_BYTES), ("upscale", config.UPSCALED_CACHE_BYTES)):
+        for relative in index.pop_lru_derived(budget, kind):
+            (STORAGE_ROOT / relative).unlink(missing_ok=True)
+            unpublish(relative)
+
+
+def link_original(file_key: str, content_hash: str, rotate: int):
+    """Points file_key at an already stored original with the same content.
+
+    The existing file is hard-linked under the new name, so the bytes are
+    stored once but an index rebuild still finds every key. Returns the index
+    record of the stored original with original_path for file_key, or None
+    if this content has not been stored in file_key's format before.
+    """
+    for record in index.find_by_hash(content_hash, rotate):
+        # A rotated original is re-encoded in the format of the name it was
+        # stored under, so it is only shared with keys of the same type.
+        if mimetypes.guess_type(record["original_path"])[0] != mimetypes.guess_type(file_key)[0]:
+            continue
+        existing = _resolve(record["original_path"])
+        # Only content-addressed folders are safe to add names to.
+        if existing is None or not ORIGINAL_DIR_RE.match(existing.parent.name):
+            continue
+        target = existing.with_name(file_key)
+        if not target.exists():
+            try:
+                os.link(existing, target)
+            except OSError:
+                # Filesystems without hard links just keep the index alias.
+                target = existing
+            else:
+                store.copy(relative_path(existing), relative_path(target))
+        record["original_path"] = relative_path(target)
+        return record
+    return None
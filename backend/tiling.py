@@ -0,0 +1,140 @@
+"""Tiled, memory-bounded upscaling.
+
+The source is split into a grid of tiles that each carry `overlap` pixels of
+context on every side. Tiles are upscaled independently (in parallel) and
+feather-blended back together one horizontal strip at a time, so only a
+strip's worth of float accumulators is ever held in memory. Finished rows are
+written straight into the output array, which can be a disk-backed memmap.
+"""
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+from . import config
+
+_tile_executor: ThreadPoolExecutor | None = None
+_tile_executor_lock = threading.Lock()
+
+
+def _get_tile_executor() -> ThreadPoolExecutor:
+    # Shared by every upscale job in this process so concurrent jobs cannot
+    # multiply the number of tile threads.
+    global _tile_executor
+    with _tile_executor_lock:
+        if _tile_executor is None:
+            _tile_executor = ThreadPoolExecutor(
+                max_workers=max(1, config.UPSCALE_TILE_WORKERS),
+                thread_name_prefix="tile-worker",
+            )
+        return _tile_executor
+
+
+def _spans(length: int, tile: int, overlap: int):
+    """Yields (core_start, core_end, pad_start, pad_end) along one axis."""
+    for start in range(0, length, tile):
+        end = min(start + tile, length)
+        yield start, end, max(0, start - overlap), min(length, end + overlap)
+
+
+def _ramp(out_start: int, out_end: int, core_start: float, core_end: float,
+          fade: float, length: float):
+    """1D blend weights for one tile edge-to-edge, in output pixels.
+
+    Weights fall linearly from 1 to 0 across a band of width 2*fade centred
+    on each interior core edge; edges on the image border are not faded.
+    """
+    pos = np.arange(out_start, out_end, dtype=np.float32) + 0.5
+    weight = np.ones_like(pos)
+    if fade > 0:
+        if core_start > 0:
+            weight = np.minimum(weight, (pos - (core_start - fade)) / (2 * fade))
+        if core_end < length:
+            weight = np.minimum(weight, ((core_end + fade) - pos) / (2 * fade))
+    # Keep a tiny floor so every output pixel has a non-zero total weight.
+    return np.clip(weight, 1e-3, 1.0)
+
+
+def tiled_upscale(img, upscale_fn, out_w: int, out_h: int, out=None,
+                  tile: int | None = None, overlap: int | None = None):
+    """Upscales img to (out_w, out_h) tile by tile.
+
+    `upscale_fn(crop, width, height)` must return `crop` resized to exactly
+    (width, height); an engine's `upscale` method fits. `out` may be any
+    writable uint8 array of shape (out_h, out_w, channels), e.g. a memmap.
+    """
+    tile = tile or config.UPSCALE_TILE_SIZE
+    overlap = config.UPSCALE_TILE_OVERLAP if overlap is None else overlap
+    in_h, in_w = img.shape[:2]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    sx, sy = out_w / in_w, out_h / in_h
+    if out is None:
+        out = np.empty((out_h, out_w, channels) if img.ndim == 3 else (out_h, out_w), np.uint8)
+
+    def render(x_span, y_span):
+        _, _, px0, px1 = x_span
+        _, _, py0, py1 = y_span
+        ox0, ox1 = round(px0 * sx), round(px1 * sx)
+        oy0, oy1 = round(py0 * sy), round(py1 * sy)
+        return upscale_fn(img[py0:py1, px0:px1], ox1 - ox0, oy1 - oy0)
+
+    x_spans = list(_spans(in_w, tile, overlap))
+    y_spans = list(_spans(in_h, tile, overlap))
+    executor = _get_tile_executor()
+
+    # Accumulators cover output rows [acc_y0, acc_y1) across the full width.
+    acc = np.zeros((0, out_w, channels), np.float32)
+    wacc = np.zeros((0, out_w, 1), np.float32)
+    acc_y0 = 0
+
+    for row, y_span in enumerate(y_spans):
+        cy0, cy1, py0, py1 = y_span
+        oy0, oy1 = round(py0 * sy), round(py1 * sy)
+
+        # Grow the accumulators down to this strip's last row, keeping the
+        # overlap band carried over from the previous strip.
+        grow = oy1 - (acc_y0 + acc.shape[0])
+        if grow > 0:
+            acc = np.concatenate([acc, np.zeros((grow, out_w, channels), np.float32)])
+            wacc = np.concatenate([wacc, np.zeros((grow, out_w, 1), np.float32)])
+
+        wy = _ramp(oy0, oy1, cy0 * sy, cy1 * sy, overlap * sy, out_h)[:, None, None]
+        futures = [executor.submit(render, x_span, y_span) for x_span in x_spans]
+        for x_span, future in zip(x_spans, futures):
+            cx0, cx1, px0, px1 = x_span
+            ox0, ox1 = round(px0 * sx), round(px1 * sx)
+            tile_out = future.result().reshape(oy1 - oy0, ox1 - ox0, channels)
+            wx = _ramp(ox0, ox1, cx0 * sx, cx1 * sx, overlap * sx, out_w)[None, :, None]
+            weight = wy * wx
+            acc[oy0 - acc_y0:oy1 - acc_y0, ox0:ox1] += tile_out * weight
+            wacc[oy0 - acc_y0:oy1 - acc_y0, ox0:ox1] += weight
+
+        # Rows above the next strip's padded start can no longer change.
+        flush_to = round(y_spans[row + 1][2] * sy) if row + 1 < len(y_spans) else out_h
+        done = flush_to - acc_y0
+        if done > 0:
+            blended = np.clip(acc[:done] / wacc[:done] + 0.5, 0, 255).astype(np.uint8)
+            out[acc_y0:flush_to] = blended.reshape(out[acc_y0:flush_to].shape)
+            acc, wacc = acc[done:], wacc[done:]
+            acc_y0 = flush_to
+
+    return out
+
+
+@contextmanager
+def disk_backed_array(shape, directory: str):
+    """A uint8 memmap in a temporary file that is removed afterwards."""
+    # Hidden, so it is never served or picked up by an index rebuild.
+    fd, path = tempfile.mkstemp(prefix=".", suffix=".tiles", dir=directory)
+    os.close(fd)
+    try:
+        yield np.memmap(path, dtype=np.uint8, mode="w+", shape=shape)
+    finally:
+        os.remove(path)
+
+
+def should_tile(width: int, height: int) -> bool:
+    return config.UPSCALE_TILE_SIZE > 0 and width * height >= config.UPSCALE_TILE_MIN_PIXELS
@@ -0,0 +1,222 @@
+"""Long-lived upscaler engines.
+
+An engine is loaded once per process (at app startup, or in each worker
+process when running a process pool) and then fed in-memory arrays, so a
+request only pays for the inference itself. Several engines can be loaded
+side by side, so each request may pick one.
+"""
+import logging
+import os
+import threading
+
+import cv2
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class UpscalerBackend:
+    """Base class for upscaler implementations.
+
+    Subclasses load any heavy state in `load` and implement `upscale`, which
+    takes a BGR uint8 array and returns one of exactly (width, height).
+    """
+
+    name = "base"
+
+    def load(self):
+        pass
+
+    def upscale(self, img, width: int, height: int):
+        raise NotImplementedError
+
+
+class LanczosUpscaler(UpscalerBackend):
+    """Lanczos interpolation plus an unsharp mask; always available, no weights needed."""
+
+    name = "lanczos"
+
+    def __init__(self, sharpen: float = 0.6):
+        self.sharpen = sharpen
+
+    def upscale(self, img, width: int, height: int):
+        if width <= img.shape[1] and height <= img.shape[0]:
+            return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        upscaled = cv2.resize(img, (width, height), interpolation=cv2.INTER_LANCZOS4)
+        if self.sharpen <= 0:
+            return upscaled
+        # Restore some of the edge contrast lost to interpolation; the blur
+        # widens with the scale factor so the mask targets the softened edges.
+        sigma = max(1.0, 0.5 * width / img.shape[1])
+        blurred = cv2.GaussianBlur(upscaled, (0, 0), sigma)
+        return cv2.addWeighted(upscaled, 1 + self.sharpen, blurred, -self.sharpen, 0)
+
+
+class DnnSuperResUpscaler(UpscalerBackend):
+    """OpenCV's dnn_superres with FSRCNN or ESPCN models: fast CPU super-resolution.
+
+    Needs opencv-contrib and the <ALGO>_x<scale>.pb models (2x, 3x and/or 4x)
+    in model_dir. The smallest model scale that reaches the target is used
+    and the result is resized to the exact size.
+    """
+
+    def __init__(self, algorithm: str, model_dir: str):
+        self.name = algorithm
+        self.model_dir = model_dir
+        self._models: dict[int, tuple] = {}
+
+    def load(self):
+        if not hasattr(cv2, "dnn_superres"):
+            raise ImportError("cv2.dnn_superres needs opencv-contrib-python-headless")
+        for scale in (2, 3, 4):
+            path = os.path.join(self.model_dir, f"{self.name.upper()}_x{scale}.pb")
+            if os.path.exists(path):
+                model = cv2.dnn_superres.DnnSuperResImpl_create()
+                model.readModel(path)
+                model.setModel(self.name, scale)
+                # A dnn network is not safe to run from several threads at once.
+                self._models[scale] = (model, threading.Lock())
+        if not self._models:
+            raise FileNotFoundError(f"No {self.name.upper()}_x*.pb models in {self.model_dir}")
+
+    def upscale(self, img, width: int, height: int):
+        factor = max(width / img.shape[1], height / img.shape[0])
+        if factor <= 1:
+            return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        scale = next((s for s in sorted(self._models) if s >= factor), max(self._models))
+        model, lock = self._models[scale]
+        with lock:
+            upscaled = model.upsample(img)
+        if upscaled.shape[1] != width or upscaled.shape[0] != height:
+            shrinking = upscaled.shape[1] > width
+            upscaled = cv2.resize(upscaled, (width, height),
+                                  interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LANCZOS4)
+        return upscaled
+
+
+class RealESRGANUpscaler(UpscalerBackend):
+    """Real-ESRGAN x4plus held in memory. Requires torch, basicsr and realesrgan."""
+
+    name = "realesrgan"
+    net_scale = 4
+
+    def __init__(self, model_path: str, device: str = "auto"):
+        self.model_path = model_path
+        self.device = device
+        self._upsampler = None
+        # RealESRGANer keeps per-call state on the instance, so serialise calls
+        # when several pool threads share one engine.
+        self._lock = threading.Lock()
+
+    def load(self):
+        import torch
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+        from realesrgan import RealESRGANer
+
+        if not os.path.exists(self.model_path):
+            raise FileNotFoundError(f"Real-ESRGAN weights not found at {self.model_path}")
+
+        device = self.device
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        model = RRDBNet(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32,
+            scale=self.net_scale,
+        )
+        self._upsampler = RealESRGANer(
+            scale=self.net_scale,
+            model_path=self.model_path,
+            model=model,
+            tile=0,
+            tile_pad=10,
+            pre_pad=0,
+            half=device == "cuda",
+            device=torch.device(device),
+        )
+
+    def upscale(self, img, width: int, height: int):
+        with self._lock:
+            enhanced, _ = self._upsampler.enhance(img, outscale=self.net_scale)
+        if enhanced.shape[1] != width or enhanced.shape[0] != height:
+            enhanced = cv2.resize(enhanced, (width, height), interpolation=cv2.INTER_LANCZOS4)
+        return enhanced
+
+
+# Every engine that can be requested, best quality first; "auto" tries them in order.
+ENGINE_NAMES = ("realesrgan", "fsrcnn", "espcn", "lanczos")
+# Engines that used to exist under another name.
+ENGINE_ALIASES = {"opencv": "lanczos"}
+
+
+class EngineUnavailable(Exception):
+    """The requested engine is unknown or its dependencies or weights are missing."""
+
+
+def create_backend(name: str) -> UpscalerBackend:
+    if name == "lanczos":
+        return LanczosUpscaler(config.UPSCALE_SHARPEN)
+    if name in ("fsrcnn", "espcn"):
+        return DnnSuperResUpscaler(name, config.SR_MODEL_DIR)
+    if name == "realesrgan":
+        return RealESRGANUpscaler(config.REALESRGAN_MODEL_PATH, config.UPSCALER_DEVICE)
+    raise EngineUnavailable(f"Unknown upscaler engine {name!r}")
+
+
+_engines: dict[str, UpscalerBackend] = {}
+_failures: dict[str, Exception] = {}
+_default_name: str | None = None
+_engine_lock = threading.Lock()
+
+
+def _load(name: str) -> UpscalerBackend:
+    # Callers hold _engine_lock. Failures are remembered so an unavailable
+    # engine does not retry its imports on every request.
+    if name in _engines:
+        return _engines[name]
+    if name in _failures:
+        raise EngineUnavailable(f"Upscaler engine {name} unavailable ({_failures[name]})")
+    backend = create_backend(name)
+    try:
+        backend.load()
+    except Exception as e:
+        _failures[name] = e
+        raise EngineUnavailable(f"Upscaler engine {name} unavailable ({e})") from e
+    logger.info("Loaded upscaler engine %s", name)
+    _engines[name] = backend
+    return backend
+
+
+def load_engine(name: str | None = None) -> UpscalerBackend:
+    """Loads an engine once for this process and returns it.
+
+    name=None means the configured UPSCALER_BACKEND. With "auto", the
+    engines in ENGINE_NAMES are tried in order and the first one whose
+    dependencies and weights are present is used.
+    """
+    global _default_name
+    with _engine_lock:
+        if name is None:
+            if _default_name is not None:
+                return _engines[_default_name]
+            configured = ENGINE_ALIASES.get(config.UPSCALER_BACKEND, config.UPSCALER_BACKEND)
+            names = ENGINE_NAMES if configured == "auto" else (configured,)
+            for candidate in names:
+                try:
+                    backend = _load(candidate)
+                except EngineUnavailable as e:
+                    if len(names) == 1:
+                        raise
+                    logger.warning("%s, trying next", e)
+                    continue
+                _default_name = candidate
+                return backend
+            raise EngineUnavailable("No upscaler engine could be loaded")
+        return _load(ENGINE_ALIASES.get(name, name))
+
+
+def get_engine(name: str | None = None) -> UpscalerBackend:
+    key = _default_name if name is None else ENGINE_ALIASES.get(name, name)
+    engine = _engines.get(key) if key is not None else None
+    return engine if engine is not None else load_engine(name)
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from fastapi import HTTPException
+
+from . import config, metrics
+from .upscaler import load_engine
+
+logger = logging.getLogger(__name__)
+
+
+class PoolFullError(HTTPException):
+    """Raised when a pool already holds as many jobs as it is allowed to queue."""
+
+    def __init__(self, pool_name: str):
+        super().__init__(
+            status_code=503,
+            detail=f"The {pool_name} pool is busy, please retry shortly.",
+            headers={"Retry-After": str(config.RETRY_AFTER)},
+        )
+
+
+class WorkerPool:
+    """A bounded executor for blocking image work.
+
+    At most `max_workers` jobs run at once and at most `max_queue` more may
+    wait for a slot. Anything beyond that is rejected immediately with a 503
+    instead of piling up on the event loop; callers that would rather wait,
+    such as batches, retry after wait_for_capacity().
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, kind: str = "thread",
+                 initializer=None, initargs: tuple = ()):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown pool kind {kind!r}, expected 'thread' or 'process'")
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executor: Executor | None = None
+        self._pending = 0
+        self._waiters: list[asyncio.Future] = []
+        self._depth_gauge = metrics.POOL_DEPTH.labels(name)
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    @property
+    def depth(self) -> int:
+        """Jobs currently running or waiting in this pool."""
+        return self._pending
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                # Spawned, not forked: a fork of this threaded server inherits
+                # the state of thread pools (its own and OpenCV's) whose
+                # threads do not exist in the child, and can hang on them.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer,
+                    initargs=self.initargs,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=f"{self.name}-worker",
+                    initializer=self.initializer,
+                    initargs=self.initargs,
+                )
+        return self._executor
+
+    def check_capacity(self):
+        """Raises PoolFullError now, e.g. before buffering an upload that could not run anyway."""
+        if self._pending >= self.capacity:
+            raise PoolFullError(self.name)
+
+    async def wait_for_capacity(self):
+        """Returns once the pool has room for another job.
+
+        Another caller may still take the slot first, so callers retry run()
+        and wait again on PoolFullError.
+        """
+        while self._pending >= self.capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the pool, raising PoolFullError when saturated."""
+        # The counter is only touched from the event loop thread, so no lock is needed.
+        self.check_capacity()
+        self._pending += 1
+        self._depth_gauge.inc()
+        executor = self._get_executor()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+        except BrokenProcessPool:
+            # A worker process died; every later job would fail the same way
+            # until the executor is replaced. Jobs sharing it fail once here.
+            if self._executor is executor:
+                logger.error("A %s pool worker process died, starting a new pool", self.name)
+                self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise HTTPException(status_code=500, detail=f"A {self.name} worker process died, please retry")
+        finally:
+            self._pending -= 1
+            self._depth_gauge.dec()
+            waiters, self._waiters = self._waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+shrink_pool = WorkerPool("shrink", config.SHRINK_WORKERS, config.SHRINK_QUEUE, kind=config.POOL_KIND)
+# Each upscale worker process loads its own engine once; in thread mode the
+# call is a no-op after the first load.
+upscale_pool = WorkerPool(
+    "upscale", config.UPSCALE_WORKERS, config.UPSCALE_QUEUE, kind=config.POOL_KIND,
+    initializer=load_engine,
+)
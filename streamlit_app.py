@@ -14,6 +14,7 @@ st.title("🖼️ AI Image Optimizer")
 
 BACKEND_URL = "http://127.0.0.1:8000"
 MIN_RES = 200 
+JOB_POLL_SECONDS = 1
 
 def start_backend():
     """Starts the FastAPI backend as a background process."""
@@ -36,7 +37,7 @@ def start_backend():
         env["PYTHONPATH"] = os.getcwd()
 
         subprocess.Popen([
-            python_exe, "-m", "uvicorn", "backend.main:app",
+            python_exe, "-m", "backend.serve",
             "--host", "127.0.0.1",
             "--port", "8000"
         ], env=env)
@@ -49,6 +50,36 @@ def start_backend():
 # Call this at the very beginning of your app
 start_backend()
 
+
+def asset_url(url: str) -> str:
+    """Storage URLs are relative to the backend, or absolute when files live in a bucket."""
+    return url if url.startswith(("http://", "https://")) else f"{BACKEND_URL}/{url}"
+
+
+@st.cache_resource
+def http_session():
+    """One pooled session for every rerun, so requests reuse open connections."""
+    return requests.Session()
+
+
+@st.cache_data(max_entries=8)
+def oriented_image(data: bytes, rotate_angle: int):
+    """The upload decoded upright (EXIF) and rotated, cached per (file, rotation)."""
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))  # Fixes smartphone auto-rotation
+    if rotate_angle != 0:
+        # PIL rotate uses counter-clockwise, so we negate the angle
+        img = img.rotate(-rotate_angle, expand=True)
+    return img
+
+
+@st.cache_data(max_entries=8)
+def prepared_upload(data: bytes, rotate_angle: int, img_format: str) -> bytes:
+    """The rotated image re-encoded in its original format, cached per (file, rotation)."""
+    buf = io.BytesIO()
+    oriented_image(data, rotate_angle).save(buf, format=img_format)
+    return buf.getvalue()
+
+
 uploaded_file = st.file_uploader("Upload Image", type=["jpg", "png", "webp"])
 
 if uploaded_file:
@@ -61,14 +92,16 @@ if uploaded_file:
         format_func=lambda x: f"{x}°"
     )
 
-    # Load image and handle EXIF + Manual Rotation
-    orig_pil = Image.open(uploaded_file)
-    orig_pil = ImageOps.exif_transpose(orig_pil) # Fixes smartphone auto-rotation
-    
-    if rotate_angle != 0:
-        # PIL rotate uses counter-clockwise, so we negate the angle
-        orig_pil = orig_pil.rotate(-rotate_angle, expand=True)
-    
+    # The backend applies EXIF orientation and rotation itself, so by default
+    # the untouched upload is sent and nothing is re-encoded here.
+    server_rotates = st.sidebar.checkbox(
+        "Send original (rotate on server)", value=True,
+        help="Untick to send the image exactly as previewed, re-encoded in the browser session.",
+    )
+
+    # Load image and handle EXIF + Manual Rotation (once per file and angle)
+    upload_bytes = uploaded_file.getvalue()
+    orig_pil = oriented_image(upload_bytes, rotate_angle)
     orig_w, orig_h = orig_pil.size
 
     # Always visible preview
@@ -114,67 +147,94 @@ if uploaded_file:
         selected_label = st.sidebar.selectbox("Select Shrink Level", list(option_map.keys()))
         target_width = option_map[selected_label]
 
-        if st.sidebar.button("Optimize Now"):
+        # All shrink levels are rendered by one request from a single decode and
+        # kept per (file, rotation), so switching levels afterwards is instant.
+        renditions_key = f"renditions:{uploaded_file.name}:{uploaded_file.size}:{rotate_angle}"
+
+        if st.sidebar.button("Optimize Now") and renditions_key not in st.session_state:
             with st.spinner("Processing & Rotating..."):
-                # 1. Convert the rotated PIL image back into bytes
-                # This ensures the backend gets the image exactly as you see it in the preview
-                buf = io.BytesIO()
-                # We save it in its original format (or PNG/JPEG)
-                img_format = uploaded_file.type.split("/")[-1].upper()
-                if img_format == "JPG": img_format = "JPEG"
-                
-                orig_pil.save(buf, format=img_format)
-                rotated_bytes = buf.getvalue()
+                if server_rotates:
+                    # 1. Send the upload as-is and let the backend rotate it once
+                    body, rotate_param = upload_bytes, rotate_angle
+                else:
+                    # 1. Send the rotated image exactly as you see it in the preview,
+                    # saved in its original format
+                    img_format = uploaded_file.type.split("/")[-1].upper()
+                    if img_format == "JPG": img_format = "JPEG"
+                    body, rotate_param = prepared_upload(upload_bytes, rotate_angle, img_format), 0
 
                 # 2. Prepare the files for the request
                 files = {
                     "file": (
                         uploaded_file.name,
-                        rotated_bytes,
+                        body,
                         uploaded_file.type,
                     )
                 }
                 
-                # 3. Send to backend (we no longer need to pass 'rotate' as a param 
-                # because the bytes are already rotated, but we keep it 0 to be safe)
-                res = requests.post(
-                    f"{BACKEND_URL}/shrink", 
-                    params={"width": target_width, "rotate": 0}, 
+                # 3. Send to backend over the pooled session
+                res = http_session().post(
+                    f"{BACKEND_URL}/shrink/renditions", 
+                    params={"widths": list(option_map.values()), "rotate": rotate_param}, 
                     files=files
                 )
 
                 if res.status_code == 200:
-                    data = res.json()
-                    # Add a cache-buster timestamp to the URL so Streamlit doesn't show old versions
-                    import time
-                    ts = int(time.time())
-                    processed_url = f"{BACKEND_URL}/{data['relative_url']}?t={ts}"
-                    
-                    st.markdown(f"### 📉 Compression Results")
-                    c1, c2 = st.columns(2)
-                    c1.metric("Original Res", f"{orig_w} x {orig_h}")
-                    c2.metric("Shrunk Res", f"{data['width']} x {data['height']}", delta=data['savings'])
-
-                    image_comparison(
-                        img1=orig_pil, 
-                        img2=processed_url, 
-                        label1=f"Original ({orig_w}x{orig_h})", 
-                        label2=f"Shrunk ({data['width']}x{data['height']})"
-                    )
+                    result = res.json()
+                    st.session_state[renditions_key] = {
+                        r["width"]: r for r in result["renditions"]
+                    }
+                    similar = [d["file_key"] for d in result.get("near_duplicates", [])]
+                    if result.get("linked_to"):
+                        st.info(f"♻️ Near-duplicate of {result['linked_to']}; reusing the stored original.")
+                    elif similar:
+                        st.info(f"🔁 Looks like already stored images: {', '.join(similar)}")
+
+        data = st.session_state.get(renditions_key, {}).get(target_width)
+        if data:
+            # Storage URLs are content-addressed and cached as immutable, so no cache-buster is needed
+            processed_url = asset_url(data['relative_url'])
+            
+            st.markdown(f"### 📉 Compression Results")
+            c1, c2 = st.columns(2)
+            c1.metric("Original Res", f"{orig_w} x {orig_h}")
+            c2.metric("Shrunk Res", f"{data['width']} x {data['height']}", delta=data['savings'])
+
+            image_comparison(
+                img1=orig_pil, 
+                img2=processed_url, 
+                label1=f"Original ({orig_w}x{orig_h})", 
+                label2=f"Shrunk ({data['width']}x{data['height']})"
+            )
 
     elif action == "AI Upscale":
+        method_map = {
+            "Server Default": None,
+            "Real-ESRGAN (best, slow)": "realesrgan",
+            "FSRCNN (fast)": "fsrcnn",
+            "ESPCN (fastest model)": "espcn",
+            "Lanczos + Sharpen (no model)": "lanczos",
+        }
+        method_label = st.sidebar.selectbox("Upscale Method", list(method_map.keys()))
+
         if st.sidebar.button("Run AI Enhancement"):
             with st.spinner("Processing..."):
-                res = requests.post(f"{BACKEND_URL}/upscale", params={"file_key": uploaded_file.name})
+                # Upscaling runs as a background job on the backend; poll until it finishes
+                params = {"file_key": uploaded_file.name}
+                if method_map[method_label]:
+                    params["method"] = method_map[method_label]
+                res = http_session().post(f"{BACKEND_URL}/upscale", params=params)
+                job = res.json() if res.status_code == 202 else None
+                while job and job["status"] in ("queued", "running"):
+                    time.sleep(JOB_POLL_SECONDS)
+                    job = http_session().get(f"{BACKEND_URL}/jobs/{job['job_id']}").json()
 
-                if res.status_code == 200:
-                    data = res.json()
-                    import time
-                    ts = int(time.time())
-                    
-                    orig_url = f"{BACKEND_URL}/{data['original_url']}?t={ts}"
-                    shrunk_url = f"{BACKEND_URL}/{data['shrunk_url']}?t={ts}" if data["shrunk_url"] else None
-                    upscale_url = f"{BACKEND_URL}/{data['upscaled_url']}?t={ts}"
+                if job and job["status"] == "succeeded":
+                    data = job["result"]
+
+                    orig_url = asset_url(data['original_url'])
+                    shrunk_url = asset_url(data['shrunk_url']) if data["shrunk_url"] else None
+                    upscale_url = asset_url(data['upscaled_url'])
 
                     tab1, tab2, tab3 = st.tabs(["🚀 AI Upscale", "📉 Shrunk", "🖼️ Full Original"])
 
@@ -183,7 +243,7 @@ if uploaded_file:
                             img1=orig_url,
                             img2=upscale_url,
                             label1=f"Original ({data['orig_res']})", 
-                            label2=f"AI Enhanced ({data['up_res']})",
+                            label2=f"Enhanced with {data['engine']} ({data['up_res']})",
                             make_responsive=True,
                             starting_position=50
                         )
@@ -199,5 +259,7 @@ if uploaded_file:
                         if orig_url:
                             st.write(f"### Original Saved Image: {data['orig_res']}")
                             st.image(orig_url, width='stretch')
+                elif res.status_code == 400:
+                    st.error(res.json()["detail"])
                 else:
                     st.error("Make sure to run 'Shrink' first to save and rotate the image on the server.")
\ No newline at end of file
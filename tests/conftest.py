@@ -0,0 +1,67 @@
+"""Shared test setup.
+
+The backend reads its configuration and STORAGE_ROOT when first imported,
+so the environment is set here, before any test module imports it. Every
+session gets its own storage root, emptied again by the storage fixture.
+"""
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+os.environ["STORAGE_ROOT"] = tempfile.mkdtemp(prefix="storage-")
+os.environ["MAINTENANCE_INTERVAL"] = "0"
+os.environ["UPSCALER_BACKEND"] = "lanczos"
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    from backend.main import app
+
+    # One app for the whole session: shutting it down closes the index.
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def storage(client):
+    """An empty storage root and index; yields the root."""
+    from backend.storage import STORAGE_ROOT, index
+
+    for path in STORAGE_ROOT.iterdir():
+        if path.name.startswith((".index", ".locks")):
+            continue
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+    index.rebuild(STORAGE_ROOT)
+    yield STORAGE_ROOT
+
+
+def photo(seed: int, width: int = 400, height: int = 300):
+    """A smooth random image, which resizes and compresses like a photo."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC), (0, 0), 3)
+
+
+@pytest.fixture
+def make_image():
+    """Returns encode(seed, width=400, height=300, ext=".jpg") -> bytes of a distinct photo."""
+    def encode(seed: int, width: int = 400, height: int = 300, ext: str = ".jpg") -> bytes:
+        return cv2.imencode(ext, photo(seed, width, height))[1].tobytes()
+
+    return encode
+
+
+def files_under(root: Path, folder: str) -> set[str]:
+    """Names of the files below root in any dated folder's subfolder folder."""
+    return {path.name for path in root.glob(f"*/{folder}/**/*") if path.is_file()}
@@ -0,0 +1,37 @@
+"""Quality targets in backend.codecs."""
+import pytest
+
+from backend.codecs import QualityTarget
+from backend.index import SHRUNK_NAME_RE
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"quality": 101}, {"quality": 0}, {"max_bytes": 0}, {"min_ssim": 1.5},
+    {"min_psnr": 0}, {"min_psnr": float("inf")},
+])
+def test_out_of_range_targets_are_rejected(kwargs):
+    with pytest.raises(ValueError):
+        QualityTarget(**kwargs)
+
+
+@pytest.mark.parametrize("kwargs, spec", [
+    ({}, "q80"), ({"max_bytes": 20000}, "b20000"), ({"min_ssim": 0.95}, "s0.95"),
+    ({"min_psnr": 40.0}, "p40"), ({"min_psnr": 1e7}, "p10000000"),
+])
+def test_specs_match_stored_file_names(kwargs, spec):
+    target = QualityTarget(**kwargs)
+    assert target.spec == spec
+    assert SHRUNK_NAME_RE.match(f"{'0' * 64}_w100_{target.spec}.webp")
+
+
+def test_formats_without_quality_share_one_spec():
+    assert QualityTarget(quality=40).spec_for("png") == QualityTarget().spec_for("png") == "lossless"
+    assert QualityTarget(quality=40).spec_for("webp") == "q40"
+    assert SHRUNK_NAME_RE.match(f"{'0' * 64}_w100_lossless.png")
+
+
+def test_goal_with_png_is_rejected(client, storage, make_image):
+    response = client.post(
+        "/shrink?format=png&max_bytes=2000", files={"file": ("a.jpg", make_image(1), "image/jpeg")}
+    )
+    assert response.status_code == 400
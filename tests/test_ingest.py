@@ -0,0 +1,49 @@
+"""Upload limits in backend.ingest."""
+import asyncio
+import io
+import struct
+import zlib
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+from backend import config, ingest
+
+
+def png_header(width: int, height: int) -> bytes:
+    """A small PNG whose header claims width x height; only the header is ever read."""
+    buffer = io.BytesIO()
+    Image.new("L", (8, 8)).save(buffer, "PNG")
+    data = bytearray(buffer.getvalue())
+    # IHDR follows the 8-byte signature: length, type, then width and height.
+    ihdr = struct.pack(">II", width, height) + bytes(data[24:29])
+    data[16:29] = ihdr
+    data[29:33] = struct.pack(">I", zlib.crc32(b"IHDR" + ihdr))
+    return bytes(data)
+
+
+def test_probe_dimensions_reads_the_header():
+    assert ingest.probe_dimensions(png_header(4000, 3000)) == (4000, 3000)
+
+
+def test_decompression_bomb_is_rejected():
+    # Far beyond twice the limit, where Pillow refuses to open the image at all.
+    side = int((config.MAX_IMAGE_PIXELS * 2) ** 0.5) + 1000
+    with pytest.raises(HTTPException) as error:
+        ingest.probe_dimensions(png_header(side, side))
+    assert error.value.status_code == 413
+
+
+def test_read_upload_rejects_a_bomb():
+    upload = UploadFile(io.BytesIO(png_header(14000, 14000)), filename="bomb.png")
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(ingest.read_upload(upload))
+    assert error.value.status_code == 413
+
+
+def test_load_member_rejects_a_bomb():
+    data = png_header(14000, 14000)
+    with pytest.raises(HTTPException) as error:
+        ingest.load_member(lambda: data, len(data))
+    assert error.value.status_code == 413
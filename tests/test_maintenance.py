@@ -0,0 +1,102 @@
+"""Storage maintenance (backend.maintenance)."""
+import time
+
+import pytest
+from conftest import files_under
+
+from backend import config, maintenance
+from backend.storage import index
+
+DAY = 24 * 3600
+
+
+def upload(client, name: str, content: bytes, width: int = 100):
+    response = client.post(f"/shrink?width={width}", files={"file": (name, content, "image/jpeg")})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def age(days: float, *file_keys: str):
+    """Makes the given keys (all when none are given) and every derived artifact look unused for days."""
+    then = time.time() - days * DAY
+    with index._lock:
+        if file_keys:
+            index._conn.executemany(
+                "UPDATE files SET updated_at = ? WHERE file_key = ?", [(then, key) for key in file_keys]
+            )
+        else:
+            index._conn.execute("UPDATE files SET updated_at = ?", (then,))
+        index._conn.execute("UPDATE derived SET last_access = ?", (then,))
+
+
+@pytest.fixture
+def archiving(monkeypatch):
+    monkeypatch.setattr(config, "ARCHIVE_ORIGINALS_DAYS", 1)
+
+
+def test_reupload_of_an_archived_key_is_served_from_the_live_copy(client, storage, make_image, archiving):
+    content = make_image(1)
+    upload(client, "f.jpg", content)
+    age(3)
+    assert maintenance.run_maintenance()["archived_originals"] == 1
+    assert index.get("f.jpg")["original_archive"]
+
+    upload(client, "f.jpg", content)
+    record = index.get("f.jpg")
+    assert record["original_archive"] is None
+    assert (storage / record["original_path"]).is_file()
+    assert client.get("/img/f.jpg?w=40").status_code == 200
+    assert client.post("/upscale?file_key=f.jpg&wait=true").status_code == 200
+
+
+def test_unused_renditions_expire_but_originals_stay(client, storage, make_image, monkeypatch):
+    monkeypatch.setattr(config, "RETAIN_SHRUNK_DAYS", 1)
+    upload(client, "f.jpg", make_image(1))
+    age(3)
+    assert maintenance.run_maintenance()["expired_shrink"] == 1
+    assert files_under(storage, "shrunk") == set()
+    assert files_under(storage, "originals") == {"f.jpg"}
+    assert index.get("f.jpg")["shrunk_path"] is None
+
+
+def test_originals_past_retention_go_with_their_renditions(client, storage, make_image, monkeypatch):
+    monkeypatch.setattr(config, "RETAIN_ORIGINALS_DAYS", 1)
+    upload(client, "old.jpg", make_image(1))
+    age(3)
+    upload(client, "new.jpg", make_image(2))
+    stats = maintenance.run_maintenance()
+    assert stats["deleted_originals"] == 1
+    assert index.get("old.jpg") is None
+    assert files_under(storage, "originals") == {"new.jpg"}
+    new_hash = index.get("new.jpg")["content_hash"]
+    assert all(name.startswith(new_hash) for name in files_under(storage, "shrunk"))
+    assert client.get("/img/old.jpg?w=40").status_code == 404
+
+
+def test_quota_deletes_the_least_recently_used_originals(client, storage, make_image, monkeypatch):
+    upload(client, "a.jpg", make_image(1))
+    age(2)
+    upload(client, "b.jpg", make_image(2))
+    age(1, "b.jpg")
+    upload(client, "c.jpg", make_image(3))
+    monkeypatch.setattr(config, "ORIGINALS_QUOTA_BYTES", index.get("c.jpg")["original_size"] + 1)
+    assert maintenance.run_maintenance()["deleted_originals"] == 2
+    assert files_under(storage, "originals") == {"c.jpg"}
+
+
+def test_archived_original_is_restored_on_use_and_replaced_on_reupload(client, storage, make_image, archiving):
+    upload(client, "f.jpg", make_image(1))
+    age(3)
+    maintenance.run_maintenance()
+    assert files_under(storage, "originals") == set()
+
+    assert client.get("/img/f.jpg?w=40").status_code == 200
+    record = index.get("f.jpg")
+    assert record["original_archive"] is None
+    assert (storage / record["original_path"]).is_file()
+
+    upload(client, "f.jpg", make_image(2))
+    record = index.get("f.jpg")
+    assert record["original_archive"] is None
+    assert files_under(storage, "originals") == {"f.jpg"}
+    assert client.get("/img/f.jpg?w=40").status_code == 200
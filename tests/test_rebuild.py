@@ -0,0 +1,97 @@
+"""Rebuilding the storage index from the files on disk (StorageIndex.rebuild)."""
+import io
+import json
+import zipfile
+
+import cv2
+import pytest
+from PIL import Image
+from conftest import photo
+
+from backend.index import ARCHIVE_DIR, ARCHIVE_MANIFEST, ORIENTATION_TAG, StorageIndex, hash_bytes, shrink_cache_key
+
+
+@pytest.fixture
+def rebuilt(tmp_path):
+    """Rebuilds a fresh index over tmp_path and returns it."""
+    built = []
+
+    def rebuild():
+        index = StorageIndex(tmp_path / ".index.db")
+        built.append(index)
+        index.rebuild(tmp_path)
+        return index
+
+    yield rebuild
+    for index in built:
+        index.close()
+
+
+def write(path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+
+
+def jpeg(seed: int, width: int = 400, height: int = 300) -> bytes:
+    return cv2.imencode(".jpg", photo(seed, width, height))[1].tobytes()
+
+
+def test_content_addressed_originals_and_renditions(tmp_path, rebuilt):
+    content = jpeg(1)
+    digest = hash_bytes(content)
+    write(tmp_path / "2026-01-01" / "originals" / digest / "a.jpg", content)
+    write(tmp_path / "2026-01-01" / "originals" / f"{digest}-r90" / "b.jpg", jpeg(2, 300, 400))
+    shrunk = f"{digest}_w100_q80.webp"
+    write(tmp_path / "2026-01-01" / "shrunk" / shrunk, cv2.imencode(".webp", photo(1, 100, 75))[1].tobytes())
+
+    index = rebuilt()
+    a, b = index.get("a.jpg"), index.get("b.jpg")
+    assert (a["content_hash"], a["rotate"]) == (digest, 0)
+    assert (a["original_width"], a["original_height"]) == (400, 300)
+    assert a["shrunk_path"] == f"2026-01-01/shrunk/{shrunk}"
+    assert (b["content_hash"], b["rotate"]) == (digest, 90)
+    assert b["shrunk_path"] is None
+    assert index.get_derived(shrink_cache_key(digest, 0, 100, "q80"))["width"] == 100
+
+
+def test_legacy_flat_originals_are_hashed(tmp_path, rebuilt):
+    content = jpeg(3)
+    write(tmp_path / "2024-05-01" / "originals" / "old.jpg", content)
+    write(tmp_path / "2024-05-01" / "shrunk" / "old.webp", cv2.imencode(".webp", photo(3, 100, 75))[1].tobytes())
+
+    record = rebuilt().get("old.jpg")
+    assert record["content_hash"] == hash_bytes(content)
+    assert record["original_path"] == "2024-05-01/originals/old.jpg"
+    assert record["shrunk_path"] == "2024-05-01/shrunk/old.webp"
+
+
+def test_archived_originals_are_found_unless_a_live_copy_exists(tmp_path, rebuilt):
+    archived, live = jpeg(4), jpeg(5)
+    member = f"{hash_bytes(archived)}/c.jpg"
+    pack = tmp_path / ARCHIVE_DIR / "originals-20260101T000000-00000000.zip"
+    pack.parent.mkdir()
+    with zipfile.ZipFile(pack, "w") as zf:
+        zf.writestr(member, archived)
+        zf.writestr(f"{hash_bytes(live)}/d.jpg", live)
+        zf.writestr(ARCHIVE_MANIFEST, json.dumps({member: ["c.jpg"], f"{hash_bytes(live)}/d.jpg": ["d.jpg"]}))
+    write(tmp_path / "2026-02-01" / "originals" / hash_bytes(live) / "d.jpg", live)
+
+    index = rebuilt()
+    c, d = index.get("c.jpg"), index.get("d.jpg")
+    assert c["original_archive"] == f"{ARCHIVE_DIR}/{pack.name}"
+    assert c["original_path"] == member
+    assert (c["original_width"], c["original_height"]) == (400, 300)
+    assert d["original_archive"] is None
+    assert d["original_path"] == f"2026-02-01/originals/{hash_bytes(live)}/d.jpg"
+
+
+def test_exif_orientation_swaps_the_recorded_size(tmp_path, rebuilt):
+    exif = Image.Exif()
+    exif[ORIENTATION_TAG] = 6
+    buf = io.BytesIO()
+    Image.new("RGB", (400, 300), "gray").save(buf, format="JPEG", exif=exif)
+    content = buf.getvalue()
+    write(tmp_path / "2026-01-01" / "originals" / hash_bytes(content) / "turned.jpg", content)
+
+    record = rebuilt().get("turned.jpg")
+    assert (record["original_width"], record["original_height"]) == (300, 400)
@@ -0,0 +1,39 @@
+"""Stored originals and the index rows pointing at them (backend.storage)."""
+from conftest import files_under
+
+from backend.storage import index
+
+
+def upload(client, name: str, content: bytes, **params):
+    query = "&".join(f"{key}={value}" for key, value in {"width": 100, **params}.items())
+    response = client.post(f"/shrink?{query}", files={"file": (name, content, "image/jpeg")})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_reused_key_lets_go_of_its_previous_original(client, storage, make_image):
+    for seed in range(3):
+        upload(client, "IMG_0001.jpg", make_image(seed))
+    record = index.get("IMG_0001.jpg")
+    originals = [path for path in storage.glob("*/originals/*/*") if path.is_file()]
+    assert [path.relative_to(storage).as_posix() for path in originals] == [record["original_path"]]
+    # Renditions of content no key uses any more went with it.
+    assert all(name.startswith(record["content_hash"]) for name in files_under(storage, "shrunk"))
+
+
+def test_shared_original_survives_reuse_of_one_key(client, storage, make_image):
+    upload(client, "a.jpg", make_image(1))
+    upload(client, "b.jpg", make_image(1))
+    upload(client, "a.jpg", make_image(2))
+    assert files_under(storage, "originals") == {"a.jpg", "b.jpg"}
+    assert client.get("/img/b.jpg?w=50").status_code == 200
+
+
+def test_identical_upload_under_another_format_is_stored_in_that_format(client, storage, make_image):
+    content = make_image(1)
+    upload(client, "first.jpg", content, rotate=90)
+    upload(client, "second.png", content, rotate=90)
+    first, second = index.get("first.jpg"), index.get("second.png")
+    assert first["content_hash"] == second["content_hash"]
+    assert (storage / first["original_path"]).read_bytes()[:2] == b"\xff\xd8"
+    assert (storage / second["original_path"]).read_bytes()[:8] == b"\x89PNG\r\n\x1a\n"
@@ -0,0 +1,34 @@
+"""Upscale jobs (POST /upscale)."""
+from backend import config, maintenance
+from backend.storage import index
+
+from test_maintenance import age, upload
+
+
+def upscale(client, file_key: str):
+    response = client.post(f"/upscale?file_key={file_key}&wait=true")
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_full_size_rendition_is_not_upscaled_to_its_own_size(client, storage, make_image):
+    upload(client, "full.jpg", make_image(1), width=400)
+
+    result = upscale(client, "full.jpg")
+    assert result["source"] == "shrunk"
+    assert result["shrunk_res"] == "200x150"
+    assert result["up_res"] == "400x300"
+
+
+def test_evicted_rendition_is_rendered_again_before_upscaling(client, storage, make_image, monkeypatch):
+    monkeypatch.setattr(config, "RETAIN_SHRUNK_DAYS", 1)
+    upload(client, "gone.jpg", make_image(2), width=100)
+    age(3)
+    maintenance.run_maintenance()
+    assert index.get("gone.jpg")["shrunk_path"] is None
+
+    result = upscale(client, "gone.jpg")
+    assert result["source"] == "shrunk"
+    assert result["shrunk_url"]
+    assert result["shrunk_res"] == "200x150"
+    assert index.get("gone.jpg")["shrunk_width"] == 200
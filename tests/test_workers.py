@@ -0,0 +1,37 @@
+"""Worker pools in backend.workers."""
+import asyncio
+import os
+from functools import partial
+
+import pytest
+from fastapi import HTTPException
+
+from backend import main
+from backend.workers import WorkerPool
+
+
+def test_process_pool_survives_an_invalid_upload(client, storage, monkeypatch, make_image):
+    pool = WorkerPool("shrink", 1, 4, kind="process")
+    monkeypatch.setattr(main, "shrink_pool", pool)
+    try:
+        bad = client.post("/shrink?width=50", files={"file": ("bad.jpg", b"not an image", "image/jpeg")})
+        assert bad.status_code == 400
+        good = client.post("/shrink?width=50", files={"file": ("good.jpg", make_image(1), "image/jpeg")})
+        assert good.status_code == 200
+    finally:
+        pool.shutdown()
+
+
+def test_process_pool_is_replaced_after_a_worker_dies():
+    pool = WorkerPool("test", 1, 4, kind="process")
+
+    async def run_both():
+        with pytest.raises(HTTPException) as error:
+            await pool.run(partial(os._exit, 1))
+        assert error.value.status_code == 500
+        return await pool.run(pow, 2, 10)
+
+    try:
+        assert asyncio.run(run_both()) == 1024
+    finally:
+        pool.shutdown()